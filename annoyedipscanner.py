@@ -9,16 +9,49 @@ import socket
 import argparse
 import math
 import ipaddress
+import asyncio
+import errno
+import select
+import struct
+import bisect
+import collections
+import array
+import sqlite3
+import json
+import csv
+import sys
+import atexit
+import signal
+import socketserver
+import stat
+try:
+    import resource     #not there on windows, the fd limit is left alone
+except ImportError:
+    resource = None
 
 parser = argparse.ArgumentParser(prog='Annoyed IP Scanner', description='Scan a network for unused IP addresses')
-parser.add_argument('-s', help='Subnet in the form of A.B.C', required=True)
+parser.add_argument('-s', help='Targets separated by commas, each one a subnet in the form of A.B.C (uses -f/-l), a CIDR block like 10.1.0.0/16, a range like 10.1.2.5-10.1.2.50 or 10.1.2.5-50, or a single IP', required=True)
 parser.add_argument('-f', help='Starting node octet, ex: 110 (default is 1)', default=1, required=False)
 parser.add_argument('-l', help='Ending node octet, ex: 155 (default is 255', default=255,  required=False)
 parser.add_argument('-p', help='Ping sweep only, not default', required=False, action='store_true')
-parser.add_argument('-g', help='Port set to scan, default is nmap default eleven', choices=['1000', 'fast'], required=False)
+parser.add_argument('-g', help='Port set to scan, fast for the nmap default eleven, 1000 for the nmap top 1000, full for every port, or ports and ranges like 1-1024,8000-8100 (default is fast)', required=False)
 parser.add_argument('-a', help='CSV portlist file to read in for TCP port scan (-p overrides this option)', required=False)
 parser.add_argument('-b', help='One port per line portlist file to read in for TCP port scan (-p overrides this option)', required=False)
-args = vars(parser.parse_args())
+parser.add_argument('-x', help='Targets to leave out of the scan, same format as -s', required=False)
+parser.add_argument('-c', help='Maximum number of TCP connections in flight at once, split across --shards and lowered to fit the open file limit (default is 1000)', default=1000, required=False)
+parser.add_argument('--shards', help='Split the scan across this many worker processes, auto for one per core (default is 1, no workers)', default='1', required=False)
+parser.add_argument('--state', help='SQLite file that keeps results between runs (default is annoyedipscanner.db when --incremental or --resume is given)', required=False)
+parser.add_argument('--incremental', help='Only probe addresses whose stored result is older than --ttl, free ones first', required=False, action='store_true')
+parser.add_argument('--resume', help='Pick an interrupted scan of the same targets up from its last checkpoint', required=False, action='store_true')
+parser.add_argument('--ttl', help='Hours a stored result stays fresh for --incremental (default is 24)', default=24, required=False)
+parser.add_argument('--no-neighbors', help='Don\'t mark addresses found in the local ARP, conntrack and socket tables as used before probing', required=False, action='store_true')
+parser.add_argument('--batch', help='No prompts and no tables, stream one record per address to --output as soon as it is decided', required=False, action='store_true')
+parser.add_argument('-o', '--output', help='File to stream one record per address to, - for stdout (default is stdout with --batch)', required=False)
+parser.add_argument('--format', help='Record format for --output, default is jsonl', choices=['jsonl', 'csv'], default='jsonl', required=False)
+parser.add_argument('--metrics', help='Write phase timings, probe outcome counts and latency histograms to this file at exit, JSON if it ends in .json otherwise Prometheus text', required=False)
+parser.add_argument('-r', help='Starting TCP probe rate in probes per second, it is scaled back when timeouts spike (default is 10000)', default=10000, required=False)
+parser.add_argument('--daemon', help='Keep running, sweep the targets again in the background and answer free address queries on this Unix socket', required=False)
+parser.add_argument('--interval', help='Seconds between the starts of two sweeps in --daemon mode (default is 300)', default=300, required=False)
 
 ####################
 # Print the header
@@ -31,35 +64,26 @@ def printHeader():
 
 ##############################################################################################################
 # Test the user input parameters for validity, is the first host less than the last,
-# does the subnet contain valid octets. Output warninigs and stop execution
+# do the targets parse. Output warninigs and stop execution
 ##############################################################################################################
-def parmChecks(first, last, subnet, csvFile, newline):
+def parmChecks(first, last, subnet, exclude, csvFile, newline):
     if(first > last) or (first < 0) or (last > 255):
         print('[!!!] The first IP in the range (-f) should be greater than zero but less than the last IP value')
         print('      the last IP in the range (-l) should be less than 255 but greater than the first IP value')   
         print('      please check your -f and -l values')
         quit()
 
-    #if there is not exactly 3 octets, there's something wrong with the formatting
-    octets = subnet.split(".")
-    if(len(octets)!= 3):
-        print(octets)
-        print('[!!!] Please check the format of the subnet parameter (-s), there are too many')
-        print('      or too few octets or the there is an extra dot separator')
-        print('      => an example would be -s 192.168.10, three octets and two dots.')
-        quit()
-
-    #separate out the first three octets for bounds checks
-    octets = subnet.split(".")
-    octet0 = int(octets[0])
-    octet1 = int(octets[1])
-    octet2 = int(octets[2])
-
-    if (octet0 < 1 or octet0 > 255) or (octet1 < 0 or octet1 > 255) or (octet2 < 0 or octet2 > 255):
-        print('[!!!] Please check the format of the subnet parameter (-s)')
-        print('      one or more octets is out of bounds, none may be less')
-        print('      than zero or greater than 255.') 
-        quit()
+    #every target has to parse, A.B.C subnets get their bounds checked on the way
+    for targetList in (subnet, exclude):
+        if targetList == None:
+            continue
+        try:
+            parseTargets(targetList, first, last)
+        except ValueError as e:
+            print('[!!!] Please check the format of the target parameters (-s/-x): ' + str(e))
+            print('      => examples are -s 192.168.10, -s 10.1.0.0/16, -s 10.1.2.5-10.1.2.50')
+            print('         or several at once separated by commas, -s 10.1.0.0/24,10.1.5.1-99')
+            quit()
 
     if (csvFile != None) and (newline !=None):
         print('[!!!] Please check the file parameters -a and -b)')
@@ -68,6 +92,576 @@ def parmChecks(first, last, subnet, csvFile, newline):
         print('      port numbers, one per line.')
         quit()
         
+##############################################################################################################
+# Turn one target into an inclusive range of integer addresses. A target is a subnet A.B.C combined with the
+# first and last host octets, a CIDR block, a range A.B.C.D-A.B.C.E or A.B.C.D-E, or one IP
+##############################################################################################################
+def parseTarget(target, first, last):
+    target = target.strip()
+    if '/' in target:
+        network = ipaddress.IPv4Network(target, strict=False)
+        if network.prefixlen >= 31:     #point to point and host routes have no network or broadcast address
+            return int(network.network_address), int(network.broadcast_address)
+        return int(network.network_address) + 1, int(network.broadcast_address) - 1
+    if '-' in target:
+        start, end = target.split('-', 1)
+        start = ipaddress.IPv4Address(start.strip())
+        end = end.strip()
+        if end.isdigit():               #just the last octet, ex: 10.1.2.5-50
+            if int(end) > 255:
+                raise ValueError(target + ' ends past 255')
+            end = ipaddress.IPv4Address((int(start) & 0xffffff00) | int(end))
+        else:
+            end = ipaddress.IPv4Address(end)
+        if start > end:
+            raise ValueError(target + ' starts after it ends')
+        return int(start), int(end)
+    octets = target.split('.')
+    if len(octets) == 3:                #the original A.B.C form
+        if not all(octet.isdigit() for octet in octets) or int(octets[0]) < 1 or max(int(octet) for octet in octets) > 255:
+            raise ValueError(target + ' has an octet out of bounds')
+        base = int(ipaddress.IPv4Address(target + '.0'))
+        return base + first, base + last
+    address = int(ipaddress.IPv4Address(target))
+    return address, address
+
+def parseTargets(targets, first, last):
+    return [parseTarget(target, first, last) for target in targets.split(',') if target.strip() != '']
+
+##############################################################################################################
+# Sort ranges and join the ones that overlap or touch so no address comes up twice
+##############################################################################################################
+def mergeRanges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+##############################################################################################################
+# Lazily walk the target ranges in order, skipping the excluded ones. Only the current address is ever held
+# so memory is the same for a /24 or a /16
+##############################################################################################################
+def targetHosts(targets, excludes=[]):
+    excludes = mergeRanges(excludes)
+    skip = 0
+    for start, end in mergeRanges(targets):
+        address = start
+        while address <= end:
+            while skip < len(excludes) and excludes[skip][1] < address:
+                skip += 1
+            if skip < len(excludes) and excludes[skip][0] <= address:
+                address = excludes[skip][1] + 1     #jump over the whole excluded range
+                continue
+            yield str(ipaddress.IPv4Address(address))
+            address += 1
+
+def targetCount(targets, excludes=[]):
+    total = 0
+    for start, end in mergeRanges(targets):
+        total += end - start + 1
+        for exStart, exEnd in mergeRanges(excludes):
+            total -= max(0, min(end, exEnd) - max(start, exStart) + 1)
+    return total
+
+probeNames = ['', 'icmp', 'tcp', 'neighbor']    #what made a host count as found
+
+##############################################################################################################
+# Scan results for every target address. An address is stored as its offset into the merged target ranges,
+# found and free are one bit each and the open ports of a host are a packed array of shorts, so a /16 fits
+# in a few kilobytes plus the ports that actually answered. Updates take a lock and are O(1), walking the
+# bitmaps hands back addresses already in order
+##############################################################################################################
+class ResultStore:
+    def __init__(self, targets):
+        self.ranges = mergeRanges(targets)
+        self.starts = [start for start, end in self.ranges]
+        self.bases = []                 #offset of the first address of each range
+        self.size = 0
+        for start, end in self.ranges:
+            self.bases.append(self.size)
+            self.size += end - start + 1
+        self.found = bytearray((self.size + 7) // 8)  #answered ICMP or a TCP connection
+        self.free = bytearray((self.size + 7) // 8)   #probed and never answered
+        self.ports = {}                 #offset -> array of open ports
+        self.how = bytearray(self.size) #index into probeNames of the probe that found the host
+        self.foundCount = 0
+        self.freeCount = 0
+        self.lock = threading.Lock()
+        self.listener = None            #called with (ip, probe) when a host is found
+        self.settler = None             #called with ip when every stage is done with a free host
+
+    def offset(self, ip):
+        address = int(ipaddress.IPv4Address(ip))
+        index = bisect.bisect_right(self.starts, address) - 1
+        if index < 0 or address > self.ranges[index][1]:
+            raise KeyError(ip + ' is not one of the targets')
+        return self.bases[index] + address - self.ranges[index][0]
+
+    def address(self, offset):
+        index = bisect.bisect_right(self.bases, offset) - 1
+        return str(ipaddress.IPv4Address(self.ranges[index][0] + offset - self.bases[index]))
+
+    def markFound(self, ip, probe=''):
+        offset = self.offset(ip)
+        byte, bit = offset >> 3, 1 << (offset & 7)
+        with self.lock:
+            if self.found[byte] & bit:
+                return
+            self.found[byte] |= bit
+            self.how[offset] = probeNames.index(probe)
+            self.foundCount += 1
+            if self.free[byte] & bit:   #a late answer wins over an earlier silence
+                self.free[byte] &= ~bit
+                self.freeCount -= 1
+        if self.listener != None:
+            self.listener(ip, probe)
+
+    def markFree(self, ip):
+        offset = self.offset(ip)
+        byte, bit = offset >> 3, 1 << (offset & 7)
+        with self.lock:
+            if (self.found[byte] | self.free[byte]) & bit:
+                return
+            self.free[byte] |= bit
+            self.freeCount += 1
+
+    #every probe there is for this host came back, if it's still free that's final
+    def markSettled(self, ip):
+        if self.settler != None and self.isFree(ip):
+            self.settler(ip)
+
+    def addPort(self, ip, port):
+        offset = self.offset(ip)
+        with self.lock:
+            ports = self.ports.setdefault(offset, array.array('H'))
+            if port not in ports:
+                ports.append(port)
+
+    def isFound(self, ip):
+        offset = self.offset(ip)
+        return bool(self.found[offset >> 3] & (1 << (offset & 7)))
+
+    def isFree(self, ip):
+        offset = self.offset(ip)
+        return bool(self.free[offset >> 3] & (1 << (offset & 7)))
+
+    def openPorts(self, ip):
+        return sorted(self.ports.get(self.offset(ip), []))
+
+    def probe(self, ip):
+        return probeNames[self.how[self.offset(ip)]]
+
+    def walk(self, bitmap, first=0, last=None):
+        if last == None:
+            last = self.size - 1
+        for byte in range(first >> 3, (last >> 3) + 1):
+            bits = bitmap[byte]
+            if bits == 0:
+                continue
+            for bit in range(8):
+                if bits & (1 << bit) and first <= byte * 8 + bit <= last:
+                    yield self.address(byte * 8 + bit)
+
+    def foundHosts(self):
+        return self.walk(self.found)
+
+    def freeHosts(self):
+        return self.walk(self.free)
+
+    #the free addresses that fall inside some ranges, only the bitmap between their offsets is read
+    def freeIn(self, ranges):
+        for start, end in mergeRanges(ranges):
+            index = max(bisect.bisect_right(self.starts, start) - 1, 0)
+            for (low, high), base in zip(self.ranges[index:], self.bases[index:]):
+                if low > end:
+                    break
+                if high >= start:
+                    yield from self.walk(self.free, base + max(start, low) - low, base + min(end, high) - low)
+
+##############################################################################################################
+# Scan state kept on disk between runs. Every address has its last state, the probe that found it, its open
+# ports, when it last answered and when it was last probed. Each run of a set of targets is recorded too, so
+# an interrupted run can be picked up again, everything probed since it started counts as done
+##############################################################################################################
+class ScanState:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS hosts (address INTEGER PRIMARY KEY, state INTEGER, probe TEXT, ports TEXT, lastSeen REAL, lastProbed REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, targets TEXT, started REAL, finished REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS portHits (subnet TEXT, port INTEGER, hits INTEGER, PRIMARY KEY (subnet, port))')
+        self.db.commit()
+        self.run = None
+        self.started = None
+
+    def close(self):
+        self.db.close()
+
+    #start a run, or with resume carry on the last unfinished run of the same targets, returns True if resumed
+    def startRun(self, targets, resume):
+        if resume:
+            row = self.db.execute('SELECT id, started FROM runs WHERE targets = ? AND finished IS NULL ORDER BY id DESC LIMIT 1', (targets,)).fetchone()
+            if row != None:
+                self.run, self.started = row
+                return True
+        self.started = time.time()
+        self.run = self.db.execute('INSERT INTO runs (targets, started) VALUES (?, ?)', (targets, self.started)).lastrowid
+        self.db.commit()
+        return False
+
+    def finishRun(self):
+        self.db.execute('UPDATE runs SET finished = ? WHERE id = ?', (time.time(), self.run))
+        self.db.commit()
+
+    #write the decided hosts of a block and commit, that's the checkpoint. Free hosts are only final once
+    #every stage is done with them, so a partial block only saves the found ones
+    def save(self, hosts, results, complete=True):
+        now = time.time()
+        found = []
+        free = []
+        hits = []
+        for ip in hosts:
+            if results.isFound(ip):
+                openPorts = results.openPorts(ip)
+                found.append((int(ipaddress.IPv4Address(ip)), results.probe(ip), ','.join(str(port) for port in openPorts), now, now))
+                hits.extend((subnetOf(ip), port) for port in openPorts)
+            elif complete and results.isFree(ip):
+                free.append((int(ipaddress.IPv4Address(ip)), now))
+        self.db.executemany('INSERT INTO hosts (address, state, probe, ports, lastSeen, lastProbed) VALUES (?, 1, ?, ?, ?, ?) '
+                            'ON CONFLICT(address) DO UPDATE SET state = 1, probe = excluded.probe, '
+                            'ports = CASE WHEN excluded.ports = \'\' THEN hosts.ports ELSE excluded.ports END, '
+                            'lastSeen = excluded.lastSeen, lastProbed = excluded.lastProbed', found)
+        self.db.executemany('INSERT INTO hosts (address, state, lastProbed) VALUES (?, 0, ?) '
+                            'ON CONFLICT(address) DO UPDATE SET state = 0, lastProbed = excluded.lastProbed', free)
+        self.db.executemany('INSERT INTO portHits (subnet, port, hits) VALUES (?, ?, 1) '
+                            'ON CONFLICT(subnet, port) DO UPDATE SET hits = hits + 1', hits)
+        self.db.commit()
+
+    #subnet -> its ports ordered by how often they've answered there
+    def portOrders(self):
+        orders = {}
+        for subnet, port in self.db.execute('SELECT subnet, port FROM portHits ORDER BY subnet, hits DESC, port'):
+            orders.setdefault(subnet, []).append(port)
+        return orders
+
+    #the addresses still to probe. Stored results newer than the cutoff go straight into the result store,
+    #the rest come back stale free first, then never seen, then stale found
+    def pendingHosts(self, targets, excludes, results, cutoff):
+        freshFound = bytearray(len(results.found))
+        freshFree = bytearray(len(results.found))
+        staleFree = bytearray(len(results.found))
+        staleFound = bytearray(len(results.found))
+        freshPorts = {}     #offset -> stored open ports of a fresh found host
+        freshProbe = {}     #offset -> stored probe of a fresh found host
+
+        for start, end in results.ranges:
+            for address, state, probe, ports, lastProbed in self.db.execute('SELECT address, state, probe, ports, lastProbed FROM hosts WHERE address BETWEEN ? AND ?', (start, end)):
+                offset = results.offset(str(ipaddress.IPv4Address(address)))
+                bit = 1 << (offset & 7)
+                if lastProbed >= cutoff:
+                    if state == 1:
+                        freshFound[offset >> 3] |= bit
+                        freshProbe[offset] = probe if probe in probeNames else ''
+                        if ports:
+                            freshPorts[offset] = ports
+                    else:
+                        freshFree[offset >> 3] |= bit
+                elif state == 1:
+                    staleFound[offset >> 3] |= bit
+                else:
+                    staleFree[offset >> 3] |= bit
+
+        def isSet(bitmap, offset):
+            return bitmap[offset >> 3] & (1 << (offset & 7))
+
+        skipped = 0
+        for ip in targetHosts(targets, excludes):
+            offset = results.offset(ip)
+            if isSet(freshFound, offset):
+                results.markFound(ip, freshProbe[offset])
+                for port in freshPorts.get(offset, '').split(','):
+                    if port.isdigit():
+                        results.addPort(ip, int(port))
+                skipped += 1
+            elif isSet(freshFree, offset):
+                results.markFree(ip)
+                skipped += 1
+            elif isSet(staleFree, offset):
+                yield ip
+        print('[+]' + str(skipped) + ' addresses have a fresh stored result and will not be probed')
+        for ip in targetHosts(targets, excludes):
+            offset = results.offset(ip)
+            if not (isSet(freshFound, offset) or isSet(freshFree, offset) or isSet(staleFree, offset) or isSet(staleFound, offset)):
+                yield ip
+        for ip in targetHosts(targets, excludes):
+            if isSet(staleFound, results.offset(ip)):
+                yield ip
+
+##############################################################################################################
+# Addresses the local kernel already knows are live, read from files only. Complete ARP (neighbor cache)
+# entries, conntrack entries that saw a reply and the far end of established TCP sockets. Anything that
+# can't be read is skipped, off linux this just finds nothing
+##############################################################################################################
+def readLines(path):
+    try:
+        with open(path) as file:
+            return file.readlines()
+    except OSError:
+        return []
+
+def neighborHosts():
+    live = set()
+
+    for line in readLines('/proc/net/arp')[1:]:
+        fields = line.split()
+        if len(fields) >= 4 and int(fields[2], 16) & 0x2 and fields[3] != '00:00:00:00:00:00':  #ATF_COM, the entry resolved
+            live.add(fields[0])
+
+    for path in ('/proc/net/nf_conntrack', '/proc/net/ip_conntrack'):
+        for line in readLines(path):
+            if 'UNREPLIED' in line or not (line.startswith('ipv4') or line.startswith('tcp') or line.startswith('udp') or line.startswith('icmp')):
+                continue
+            sources = [field[4:] for field in line.split() if field.startswith('src=')]
+            if len(sources) >= 2:
+                live.update(sources[:2])    #the flow got a reply, both of its ends are up
+
+    for line in readLines('/proc/net/tcp')[1:]:
+        fields = line.split()
+        if len(fields) >= 4 and fields[3] == '01':  #ESTABLISHED
+            remote = fields[2].split(':')[0]
+            live.add(socket.inet_ntoa(struct.pack('=I', int(remote, 16))))   #the kernel prints it as a host order u32
+
+    live.discard('0.0.0.0')
+    return live
+
+##############################################################################################################
+# Mark the addresses that are in the neighbor tables as found as they come up and keep them out of the
+# probe queues
+##############################################################################################################
+def skipNeighbors(hosts, neighbors, results):
+    for ip in hosts:
+        if ip in neighbors:
+            results.markFound(ip, 'neighbor')
+            continue
+        yield ip
+
+##############################################################################################################
+# Streams one JSONL or CSV record per address as soon as its state is decided. A found host is written the
+# moment it answers, a free host once its last probe comes back. Every address gets one record and the first
+# one stands, a host the deep scan finds after it was written as free keeps its free record. Writes are
+# buffered and a timer flushes them once a second, so whatever reads the stream sees results while the scan
+# is still going
+##############################################################################################################
+class ResultWriter:
+    def __init__(self, stream, fmt, results):
+        self.stream = stream
+        self.fmt = fmt
+        self.results = results
+        self.written = bytearray(len(results.found))  #addresses that have a record already
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.flushLoop, daemon=True)
+        self.csv = None
+        if fmt == 'csv':
+            self.csv = csv.writer(stream)
+            self.csv.writerow(['ip', 'state', 'probe', 'ports', 'time'])
+
+    def start(self):
+        self.thread.start()
+
+    def flushLoop(self):
+        while not self.stopped.wait(1.0):
+            with self.lock:
+                self.flush()
+
+    def write(self, ip, state, probe):
+        ports = self.results.openPorts(ip)
+        offset = self.results.offset(ip)
+        with self.lock:
+            if self.written[offset >> 3] & (1 << (offset & 7)):
+                return      #one record per host, however many times it's settled or found
+            self.written[offset >> 3] |= 1 << (offset & 7)
+            if self.csv != None:
+                self.csv.writerow([ip, state, probe, ' '.join(str(port) for port in ports), round(time.time(), 3)])
+            else:
+                self.stream.write(json.dumps({'ip': ip, 'state': state, 'probe': probe, 'ports': ports, 'time': round(time.time(), 3)}) + '\n')
+
+    def flush(self):
+        self.stream.flush()
+
+    def isWritten(self, ip):
+        offset = self.results.offset(ip)
+        return self.written[offset >> 3] & (1 << (offset & 7))
+
+    #the results store calls this for every found host
+    def found(self, ip, probe):
+        self.write(ip, 'found', probe)
+
+    #and this for every free host that's final
+    def free(self, ip):
+        self.write(ip, 'free', '')
+
+    #every stage is done with these hosts, the ones still free are final
+    def settle(self, hosts):
+        for ip in hosts:
+            if self.results.isFree(ip) and not self.isWritten(ip):
+                self.write(ip, 'free', '')
+        with self.lock:
+            self.flush()
+
+    #write whatever hasn't been written yet, stored results from the scan state end up here
+    def finish(self):
+        self.settle(self.results.freeHosts())
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+##############################################################################################################
+# Take up to 'size' items off an iterator, an empty list means it ran out
+##############################################################################################################
+def takeBatch(items, size):
+    return [item for x, item in zip(range(size), items)]
+
+##############################################################################################################
+# Instrumentation kept on all the time. Wall time per phase, probe outcomes per stage and a latency histogram
+# per stage with fixed buckets, every update is a lock, a dict bump and a bisect
+##############################################################################################################
+latencyBuckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]    #seconds, upper bounds
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.reset()
+
+    def reset(self):
+        self.phases = {}        #phase -> seconds
+        self.outcomes = {}      #(stage, outcome) -> count
+        self.histograms = {}    #stage -> [count per bucket, last one is past the end, sum of seconds]
+
+    def addPhase(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, stage, outcome, number=1):
+        with self.lock:
+            self.outcomes[(stage, outcome)] = self.outcomes.get((stage, outcome), 0) + number
+
+    #one probe, result is a connect_ex style errno. Latency is only kept for probes that got an answer
+    def probe(self, stage, result, seconds):
+        if result == 0:
+            outcome = 'success'
+        elif result == errno.ECONNREFUSED:
+            outcome = 'rst'
+        elif result == errno.EAGAIN:
+            outcome = 'timeout'
+        else:
+            outcome = 'error'
+        with self.lock:
+            self.outcomes[(stage, outcome)] = self.outcomes.get((stage, outcome), 0) + 1
+            if outcome == 'success' or outcome == 'rst':
+                histogram = self.histograms.setdefault(stage, [0] * (len(latencyBuckets) + 2))
+                histogram[bisect.bisect_left(latencyBuckets, seconds)] += 1
+                histogram[-1] += seconds
+
+    def probeCount(self):
+        return sum(self.outcomes.values())
+
+    def export(self):
+        with self.lock:
+            return {'phases': dict(self.phases), 'outcomes': dict(self.outcomes), 'histograms': {stage: list(histogram) for stage, histogram in self.histograms.items()}}
+
+    #fold in the counts from another process, its phase times overlap ours so they're left out
+    def merge(self, exported):
+        with self.lock:
+            for key, number in exported['outcomes'].items():
+                self.outcomes[key] = self.outcomes.get(key, 0) + number
+            for stage, histogram in exported['histograms'].items():
+                mine = self.histograms.setdefault(stage, [0] * (len(latencyBuckets) + 2))
+                for index in range(len(histogram)):
+                    mine[index] += histogram[index]
+
+    def summary(self):
+        exported = self.export()
+        stages = {}
+        for (stage, outcome), number in exported['outcomes'].items():
+            stages.setdefault(stage, {})[outcome] = number
+        histograms = {}
+        for stage, histogram in exported['histograms'].items():
+            cumulative = [sum(histogram[:index+1]) for index in range(len(histogram) - 1)]  #le buckets, same as prometheus
+            histograms[stage] = {'buckets': dict(zip([str(bound) for bound in latencyBuckets] + ['+Inf'], cumulative)), 'count': cumulative[-1], 'sum': round(histogram[-1], 6)}
+        return {'seconds': round(time.time() - self.started, 3), 'phases': {phase: round(seconds, 3) for phase, seconds in exported['phases'].items()},
+                'probes': stages, 'latency': histograms}
+
+    def prometheus(self):
+        exported = self.export()
+        lines = ['# HELP annoyedipscanner_phase_seconds Wall time spent in each scan phase',
+                 '# TYPE annoyedipscanner_phase_seconds gauge']
+        for phase, seconds in sorted(exported['phases'].items()):
+            lines.append('annoyedipscanner_phase_seconds{phase="%s"} %f' % (phase, seconds))
+        lines += ['# HELP annoyedipscanner_probes_total Probes by stage and outcome',
+                  '# TYPE annoyedipscanner_probes_total counter']
+        for (stage, outcome), number in sorted(exported['outcomes'].items()):
+            lines.append('annoyedipscanner_probes_total{stage="%s",outcome="%s"} %d' % (stage, outcome, number))
+        lines += ['# HELP annoyedipscanner_probe_latency_seconds Time to a SYN-ACK, RST or echo reply',
+                  '# TYPE annoyedipscanner_probe_latency_seconds histogram']
+        for stage, histogram in sorted(exported['histograms'].items()):
+            total = 0
+            for bound, number in zip([str(bound) for bound in latencyBuckets] + ['+Inf'], histogram[:-1]):
+                total += number
+                lines.append('annoyedipscanner_probe_latency_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, total))
+            lines.append('annoyedipscanner_probe_latency_seconds_sum{stage="%s"} %f' % (stage, histogram[-1]))
+            lines.append('annoyedipscanner_probe_latency_seconds_count{stage="%s"} %d' % (stage, total))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        with open(path, 'w') as file:
+            if path.endswith('.json'):
+                json.dump(self.summary(), file, indent=2)
+            else:
+                file.write(self.prometheus())
+
+metrics = Metrics()
+
+##############################################################################################################
+# Live progress line on stderr, addresses decided so far, probe rate and a guess at the time left
+##############################################################################################################
+class Progress:
+    def __init__(self, total, results, interval=1.0):
+        self.total = total
+        self.results = results
+        self.interval = interval
+        self.started = time.time()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.draw()
+
+    def draw(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        done = self.results.foundCount + self.results.freeCount
+        eta = '--'
+        if done > 0:
+            left = int((self.total - done) * elapsed / done)
+            eta = str(left // 60) + 'm' + str(left % 60).rjust(2, '0') + 's'
+        percent = 100.0 * done / self.total if self.total > 0 else 100.0
+        sys.stderr.write('\r[~]' + str(done) + '/' + str(self.total) + ' addresses (' + str(round(percent, 1)) + '%), ' + str(self.results.foundCount) + ' found, '
+                         + str(round(metrics.probeCount() / elapsed)) + ' probes/sec, ETA ' + eta + '   ')
+        sys.stderr.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.draw()
+        sys.stderr.write('\n')
+
 ##############################################################################################################
 # Print the ports read in from a file
 ##############################################################################################################
@@ -97,24 +691,82 @@ def printPortList(portPrint):
     print('\n')
      
 ##############################################################################################################
-# Check parameter boundaries, build the port list
+# Port profiles. The order ports are probed in matters, a host only has to answer once to count as used, so
+# every list is sorted with the ports most often found open first, from nmap's port frequency table. Ports
+# that aren't ranked keep their place behind the ranked ones
+##############################################################################################################
+portProfiles = {'fast': [21, 22, 23, 25, 53, 80, 110, 139, 443, 445, 3389],
+                '1000': [1,3,4,6,7,9,13,17,19,20,21,22,23,24,25,26,30,32,33,37,42,43,49,53,70,79,80,81,82,83,84,85,88,89,90,99,100,106,109,110,111,113,119,125,135,139,143,144,146,161,163,179,199,211,212,222,254,255,256,259,264,280,301,306,311,340,366,389,406,407,416,417,425,427,443,444,445,458,464,465,481,497,500,512,513,514,515,524,541,543,544,545,548,554,555,563,587,593,616,617,625,631,636,646,648,666,667,668,683,687,691,700,705,711,714,720,722,726,749,765,777,783,787,800,801,808,843,873,880,888,898,900,901,902,903,911,912,981,987,990,992,993,995,999,1000,1001,1002,1007,1009,1010,1011,1021,1022,1023,1024,1025,1026,1027,1028,1029,1030,1031,1032,1033,1034,1035,1036,1037,1038,1039,1040,1041,1042,1043,1044,1045,1046,1047,1048,1049,1050,1051,1052,1053,1054,1055,1056,1057,1058,1059,1060,1061,1062,1063,1064,1065,1066,1067,1068,1069,1070,1071,1072,1073,1074,1075,1076,1077,1078,1079,1080,1081,1082,1083,1084,1085,1086,1087,1088,1089,1090,1091,1092,1093,1094,1095,1096,1097,1098,1099,1100,1102,1104,1105,1106,1107,1108,1110,1111,1112,1113,1114,1117,1119,1121,1122,1123,1124,1126,1130,1131,1132,1137,1138,1141,1145,1147,1148,1149,1151,1152,1154,1163,1164,1165,1166,1169,1174,1175,1183,1185,1186,1187,1192,1198,1199,1201,1213,1216,1217,1218,1233,1234,1236,1244,1247,1248,1259,1271,1272,1277,1287,1296,1300,1301,1309,1310,1311,1322,1328,1334,1352,1417,1433,1434,1443,1455,1461,1494,1500,1501,1503,1521,1524,1533,1556,1580,1583,1594,1600,1641,1658,1666,1687,1688,1700,1717,1718,1719,1720,1721,1723,1755,1761,1782,1783,1801,1805,1812,1839,1840,1862,1863,1864,1875,1900,1914,1935,1947,1971,1972,1974,1984,1998,1999,2000,2001,2002,2003,2004,2005,2006,2007,2008,2009,2010,2013,2020,2021,2022,2030,2033,2034,2035,2038,2040,2041,2042,2043,2045,2046,2047,2048,2049,2065,2068,2099,2100,2103,2105,2106,2107,2111,2119,2121,2126,2135,2144,2160,2161,2170,2179,2190,2191,2196,2200,2222,2251,2260,2288,2301,2323,2366,2381,2382,2383,2393,2394,2399,2401,2492,2500,2522,2525,2557,2601,2602,2604,2605,2607,2608,2638,2701,2702,2710,2717,2718,2725,2800,2809,2811,2869,2875,2909,2910,2920,2967,2968,2998,3000,3001,3003,3005,3006,3007,3011,3013,3017,3030,3031,3052,3071,3077,3128,3168,3211,3221,3260,3261,3268,3269,3283,3300,3301,3306,3322,3323,3324,3325,3333,3351,3367,3369,3370,3371,3372,3389,3390,3404,3476,3493,3517,3527,3546,3551,3580,3659,3689,3690,3703,3737,3766,3784,3800,3801,3809,3814,3826,3827,3828,3851,3869,3871,3878,3880,3889,3905,3914,3918,3920,3945,3971,3986,3995,3998,4000,4001,4002,4003,4004,4005,4006,4045,4111,4125,4126,4129,4224,4242,4279,4321,4343,4443,4444,4445,4446,4449,4550,4567,4662,4848,4899,4900,4998,5000,5001,5002,5003,5004,5009,5030,5033,5050,5051,5054,5060,5061,5080,5087,5100,5101,5102,5120,5190,5200,5214,5221,5222,5225,5226,5269,5280,5298,5357,5405,5414,5431,5432,5440,5500,5510,5544,5550,5555,5560,5566,5631,5633,5666,5678,5679,5718,5730,5800,5801,5802,5810,5811,5815,5822,5825,5850,5859,5862,5877,5900,5901,5902,5903,5904,5906,5907,5910,5911,5915,5922,5925,5950,5952,5959,5960,5961,5962,5963,5987,5988,5989,5998,5999,6000,6001,6002,6003,6004,6005,6006,6007,6009,6025,6059,6100,6101,6106,6112,6123,6129,6156,6346,6389,6502,6510,6543,6547,6565,6566,6567,6580,6646,6666,6667,6668,6669,6689,6692,6699,6779,6788,6789,6792,6839,6881,6901,6969,7000,7001,7002,7004,7007,7019,7025,7070,7100,7103,7106,7200,7201,7402,7435,7443,7496,7512,7625,7627,7676,7741,7777,7778,7800,7911,7920,7921,7937,7938,7999,8000,8001,8002,8007,8008,8009,8010,8011,8021,8022,8031,8042,8045,8080,8081,8082,8083,8084,8085,8086,8087,8088,8089,8090,8093,8099,8100,8180,8181,8192,8193,8194,8200,8222,8254,8290,8291,8292,8300,8333,8383,8400,8402,8443,8500,8600,8649,8651,8652,8654,8701,8800,8873,8888,8899,8994,9000,9001,9002,9003,9009,9010,9011,9040,9050,9071,9080,9081,9090,9091,9099,9100,9101,9102,9103,9110,9111,9200,9207,9220,9290,9415,9418,9485,9500,9502,9503,9535,9575,9593,9594,9595,9618,9666,9876,9877,9878,9898,9900,9917,9929,9943,9944,9968,9998,9999,10000,10001,10002,10003,10004,10009,10010,10012,10024,10025,10082,10180,10215,10243,10566,10616,10617,10621,10626,10628,10629,10778,11110,11111,11967,12000,12174,12265,12345,13456,13722,13782,13783,14000,14238,14441,14442,15000,15002,15003,15004,15660,15742,16000,16001,16012,16016,16018,16080,16113,16992,16993,17877,17988,18040,18101,18988,19101,19283,19315,19350,19780,19801,19842,20000,20005,20031,20221,20222,20828,21571,22939,23502,24444,24800,25734,25735,26214,27000,27352,27353,27355,27356,27715,28201,30000,30718,30951,31038,31337,32768,32769,32770,32771,32772,32773,32774,32775,32776,32777,32778,32779,32780,32781,32782,32783,32784,32785,33354,33899,34571,34572,34573,35500,38292,40193,40911,41511,42510,44176,44442,44443,44501,45100,48080,49152,49153,49154,49155,49156,49157,49158,49159,49160,49161,49163,49165,49167,49175,49176,49400,49999,50000,50001,50002,50003,50006,50300,50389,50500,50636,50800,51103,51493,52673,52822,52848,52869,54045,54328,55055,55056,55555,55600,56737,56738,57294,57797,58080,60020,60443,61532,61900,62078,63331,64623,64680,65000,65129,65389]}
+
+portRank = [80, 23, 443, 21, 22, 25, 3389, 110, 445, 139, 143, 53, 135, 3306, 8080, 1723, 111, 995, 993, 5900,
+            1025, 587, 8888, 199, 1720, 465, 548, 113, 81, 6001, 10000, 514, 5060, 179, 1026, 2000, 8443, 8000,
+            32768, 554, 26, 1433, 49152, 2001, 515, 8008, 49154, 1027, 5666, 646, 5000, 5631, 631, 49153, 8081,
+            2049, 88, 79, 5800, 106, 2121, 1110, 49155, 6000, 513, 990, 5357, 427, 49156, 543, 544, 5101, 144,
+            7, 389]
+
+def orderPorts(ports, first=portRank):
+    ports = list(dict.fromkeys(ports))     #drop repeats, keep the order
+    inList = set(ports)
+    ranked = [port for port in dict.fromkeys(first) if port in inList]
+    seen = set(ranked)
+    return array.array('H', ranked + [port for port in ports if port not in seen])
+
+#turn ports and ranges like 22,80,1-1024,8000-8100 into a list of ports
+def compilePorts(spec):
+    ports = []
+    for part in spec.split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        bounds = part.split('-')
+        if len(bounds) > 2 or not all(bound.strip().isdigit() for bound in bounds):
+            raise ValueError(part + ' is not a port or a range of ports')
+        low, high = int(bounds[0]), int(bounds[-1])
+        if low < 1 or high > 65535 or low > high:
+            raise ValueError(part + ' is out of bounds, ports run from 1 to 65535')
+        ports.extend(range(low, high+1))
+    if len(ports) == 0:
+        raise ValueError('no ports given')
+    return ports
+
+#the first three octets of an address, the subnet that learned port orders are kept for
+def subnetOf(ip):
+    return ip.rsplit('.', 1)[0]
+
+#the ports for a port set, a profile name or ports and ranges, raises ValueError for anything else
+def portSet(portDepth):
+    if portDepth == None:
+        portDepth = 'fast'
+    if portDepth in portProfiles:
+        return orderPorts(portProfiles[portDepth])
+    if portDepth == 'full':
+        return orderPorts(range(1, 65536))
+    return orderPorts(compilePorts(portDepth))
+
+##############################################################################################################
+# Check parameter boundaries, build the port list, returned as a packed array of shorts
 ##############################################################################################################        
-def buildPortList(pingOnly, portDepth, firstPort, lastPort, portFile, fileType):
+def buildPortList(pingOnly, portDepth, firstPort, lastPort, portFile, fileType, batch=False):
     pts = []        #the ports to be checked
     temp = []       #list to temporarily hold the ports
     cont = '0'
     
     if pingOnly == False:           #if we're only doing a ping sweep we'll skip building a port list (-p overrides port selection)
         if portFile == None:        #if we're loading ports from a file, skip defaults (-a/-b overrides default selections)
+            try:
+                pts = portSet(portDepth)
+            except ValueError as e:
+                print('[!!!] Please check the port set (-g): ' + str(e))
+                print('      => examples are -g fast, -g 1000, -g 1-1024,8000-8100')
+                quit()
             if portDepth == '1000': #if the port depth spec is set to 1000 load the nmap default 1000 ports
                 print('[+]Testing with the Nmap top 1000 ports')
-                pts = [1,3,4,6,7,9,13,17,19,20,21,22,23,24,25,26,30,32,33,37,42,43,49,53,70,79,80,81,82,83,84,85,88,89,90,99,100,106,109,110,111,113,119,125,135,139,143,144,146,161,163,179,199,211,212,222,254,255,256,259,264,280,301,306,311,340,366,389,406,407,416,417,425,427,443,444,445,458,464,465,481,497,500,512,513,514,515,524,541,543,544,545,548,554,555,563,587,593,616,617,625,631,636,646,648,666,667,668,683,687,691,700,705,711,714,720,722,726,749,765,777,783,787,800,801,808,843,873,880,888,898,900,901,902,903,911,912,981,987,990,992,993,995,999,1000,1001,1002,1007,1009,1010,1011,1021,1022,1023,1024,1025,1026,1027,1028,1029,1030,1031,1032,1033,1034,1035,1036,1037,1038,1039,1040,1041,1042,1043,1044,1045,1046,1047,1048,1049,1050,1051,1052,1053,1054,1055,1056,1057,1058,1059,1060,1061,1062,1063,1064,1065,1066,1067,1068,1069,1070,1071,1072,1073,1074,1075,1076,1077,1078,1079,1080,1081,1082,1083,1084,1085,1086,1087,1088,1089,1090,1091,1092,1093,1094,1095,1096,1097,1098,1099,1100,1102,1104,1105,1106,1107,1108,1110,1111,1112,1113,1114,1117,1119,1121,1122,1123,1124,1126,1130,1131,1132,1137,1138,1141,1145,1147,1148,1149,1151,1152,1154,1163,1164,1165,1166,1169,1174,1175,1183,1185,1186,1187,1192,1198,1199,1201,1213,1216,1217,1218,1233,1234,1236,1244,1247,1248,1259,1271,1272,1277,1287,1296,1300,1301,1309,1310,1311,1322,1328,1334,1352,1417,1433,1434,1443,1455,1461,1494,1500,1501,1503,1521,1524,1533,1556,1580,1583,1594,1600,1641,1658,1666,1687,1688,1700,1717,1718,1719,1720,1721,1723,1755,1761,1782,1783,1801,1805,1812,1839,1840,1862,1863,1864,1875,1900,1914,1935,1947,1971,1972,1974,1984,1998,1999,2000,2001,2002,2003,2004,2005,2006,2007,2008,2009,2010,2013,2020,2021,2022,2030,2033,2034,2035,2038,2040,2041,2042,2043,2045,2046,2047,2048,2049,2065,2068,2099,2100,2103,2105,2106,2107,2111,2119,2121,2126,2135,2144,2160,2161,2170,2179,2190,2191,2196,2200,2222,2251,2260,2288,2301,2323,2366,2381,2382,2383,2393,2394,2399,2401,2492,2500,2522,2525,2557,2601,2602,2604,2605,2607,2608,2638,2701,2702,2710,2717,2718,2725,2800,2809,2811,2869,2875,2909,2910,2920,2967,2968,2998,3000,3001,3003,3005,3006,3007,3011,3013,3017,3030,3031,3052,3071,3077,3128,3168,3211,3221,3260,3261,3268,3269,3283,3300,3301,3306,3322,3323,3324,3325,3333,3351,3367,3369,3370,3371,3372,3389,3390,3404,3476,3493,3517,3527,3546,3551,3580,3659,3689,3690,3703,3737,3766,3784,3800,3801,3809,3814,3826,3827,3828,3851,3869,3871,3878,3880,3889,3905,3914,3918,3920,3945,3971,3986,3995,3998,4000,4001,4002,4003,4004,4005,4006,4045,4111,4125,4126,4129,4224,4242,4279,4321,4343,4443,4444,4445,4446,4449,4550,4567,4662,4848,4899,4900,4998,5000,5001,5002,5003,5004,5009,5030,5033,5050,5051,5054,5060,5061,5080,5087,5100,5101,5102,5120,5190,5200,5214,5221,5222,5225,5226,5269,5280,5298,5357,5405,5414,5431,5432,5440,5500,5510,5544,5550,5555,5560,5566,5631,5633,5666,5678,5679,5718,5730,5800,5801,5802,5810,5811,5815,5822,5825,5850,5859,5862,5877,5900,5901,5902,5903,5904,5906,5907,5910,5911,5915,5922,5925,5950,5952,5959,5960,5961,5962,5963,5987,5988,5989,5998,5999,6000,6001,6002,6003,6004,6005,6006,6007,6009,6025,6059,6100,6101,6106,6112,6123,6129,6156,6346,6389,6502,6510,6543,6547,6565,6566,6567,6580,6646,6666,6667,6668,6669,6689,6692,6699,6779,6788,6789,6792,6839,6881,6901,6969,7000,7001,7002,7004,7007,7019,7025,7070,7100,7103,7106,7200,7201,7402,7435,7443,7496,7512,7625,7627,7676,7741,7777,7778,7800,7911,7920,7921,7937,7938,7999,8000,8001,8002,8007,8008,8009,8010,8011,8021,8022,8031,8042,8045,8080,8081,8082,8083,8084,8085,8086,8087,8088,8089,8090,8093,8099,8100,8180,8181,8192,8193,8194,8200,8222,8254,8290,8291,8292,8300,8333,8383,8400,8402,8443,8500,8600,8649,8651,8652,8654,8701,8800,8873,8888,8899,8994,9000,9001,9002,9003,9009,9010,9011,9040,9050,9071,9080,9081,9090,9091,9099,9100,9101,9102,9103,9110,9111,9200,9207,9220,9290,9415,9418,9485,9500,9502,9503,9535,9575,9593,9594,9595,9618,9666,9876,9877,9878,9898,9900,9917,9929,9943,9944,9968,9998,9999,10000,10001,10002,10003,10004,10009,10010,10012,10024,10025,10082,10180,10215,10243,10566,10616,10617,10621,10626,10628,10629,10778,11110,11111,11967,12000,12174,12265,12345,13456,13722,13782,13783,14000,14238,14441,14442,15000,15002,15003,15004,15660,15742,16000,16001,16012,16016,16018,16080,16113,16992,16993,17877,17988,18040,18101,18988,19101,19283,19315,19350,19780,19801,19842,20000,20005,20031,20221,20222,20828,21571,22939,23502,24444,24800,25734,25735,26214,27000,27352,27353,27355,27356,27715,28201,30000,30718,30951,31038,31337,32768,32769,32770,32771,32772,32773,32774,32775,32776,32777,32778,32779,32780,32781,32782,32783,32784,32785,33354,33899,34571,34572,34573,35500,38292,40193,40911,41511,42510,44176,44442,44443,44501,45100,48080,49152,49153,49154,49155,49156,49157,49158,49159,49160,49161,49163,49165,49167,49175,49176,49400,49999,50000,50001,50002,50003,50006,50300,50389,50500,50636,50800,51103,51493,52673,52822,52848,52869,54045,54328,55055,55056,55555,55600,56737,56738,57294,57797,58080,60020,60443,61532,61900,62078,63331,64623,64680,65000,65129,65389]
-            if portDepth == 'fast': #if we're doing a quicker scan we'll go with the nmap default 11
-                pts = [21, 22, 23, 25, 53, 80, 110, 139, 443, 445, 3389]
+            if portDepth in [None, 'fast']: #the nmap default 11 unless we were told otherwise
                 print('[+]Testing with the 11 default Nmap ports')
-            if portDepth == None:   #if the port depth was not specified default to the nmap default 11
-                print('[+]Testing with the 11 default Nmap ports')
-                pts = [21, 22, 23, 25, 53, 80, 110, 139, 443, 445, 3389]
+            if portDepth == 'full': #every port there is
+                print('[+]Testing with all 65535 ports')
+            if portDepth not in [None, 'fast', '1000', 'full']:    #anything else is a list of ports and ranges
+                print('[+]Testing with ' + str(len(pts)) + ' ports from ' + portDepth)
         else:
             if fileType == 'c': #if the port file was specified and the file type is CSV (-a)
                 try:            
@@ -127,10 +779,11 @@ def buildPortList(pingOnly, portDepth, firstPort, lastPort, portFile, fileType):
                     if(len(pts)==0):
                         print('[!] ' + portFile + ' is empty. Quitting.')
                         quit()
-                    printPortList(pts)
-                    cont = input('Press 0 (zero) to quit, anything else to continue : ')
-                    if cont == '0':
-                        quit()
+                    if batch == False:      #nobody to ask in batch mode
+                        printPortList(pts)
+                        cont = input('Press 0 (zero) to quit, anything else to continue : ')
+                        if cont == '0':
+                            quit()
                     f.close()                                                   #close the file
                 except OSError:
                     print("Could not open/read file:", portFile)                #if an error ocurred
@@ -144,114 +797,922 @@ def buildPortList(pingOnly, portDepth, firstPort, lastPort, portFile, fileType):
                     if(len(pts)==0):
                         print('[!] ' + portFile + ' is empty. Quitting.')
                         quit()
-                    printPortList(pts)
-                    cont = input('Press 0 (zero) to quit, anything else to continue : ')
-                    if cont == '0':
-                        quit()
+                    if batch == False:      #nobody to ask in batch mode
+                        printPortList(pts)
+                        cont = input('Press 0 (zero) to quit, anything else to continue : ')
+                        if cont == '0':
+                            quit()
                 except OSError:
                     print("Could not open/read file:", portFile)
-    return pts      #return the port list
+    return orderPorts(pts)      #return the port list, the ports most likely to answer go first
 
 ##############################################################################################################
-# Do a ping sweep
+# Do a ping sweep, echoes go out from one ICMP socket when we can open one, otherwise fall back to the
+# system ping command with a pool of threads. Reply times go into the round trip estimates when given. An
+# engine that's passed in is left open, progress goes to 'say'
 ##############################################################################################################
-def pingSweep(sub, nodes, ipFreeList, ipFoundList):
-    print("\n[+]Starting ping sweep\n")
+def noPrint(*args):
+    pass
+
+def pingSweep(hosts, results, rtt=None, batchSize=1024, final=False, engine=None, say=print):
+    say("\n[+]Starting ping sweep\n")
+    started = time.perf_counter()
+
+    def recordReply(ip, seconds):
+        metrics.probe('icmp', 0, seconds)
+        results.markFound(ip, 'icmp')
+        if rtt != None:
+            rtt.update(ip, seconds)     #seed the TCP timeouts with what ICMP saw
+
+    hosts = iter(hosts)
+    ownEngine = engine == None
+    if ownEngine:
+        engine = PingEngine()
+    if not engine.available():
+        say('[!]Could not open an ICMP socket, falling back to the ping command')
+
+    #take the hosts a batch at a time, the generator is never expanded all at once
     with concurrent.futures.ThreadPoolExecutor(max_workers=200) as executor:
-        future_to_ping = {executor.submit(pingHost, (sub+str(node)), ipFreeList, ipFoundList): node for node in nodes}
-        for future in concurrent.futures.as_completed(future_to_ping):
-            node = future_to_ping[future]
-            try:
-                data = future.result()
-            except Exception as e:
-                print('%s generated an exception: %s' % (node, e))
-    print("[+]Ping sweep complete\n")
+        while True:
+            batch = takeBatch(hosts, batchSize)
+            if len(batch) == 0:
+                break
+            if engine.available():
+                for ip in engine.sweep(batch, recordReply):
+                    metrics.count('icmp', 'timeout')
+                    results.markFree(ip)
+                    if final:
+                        results.markSettled(ip)     #nothing else will probe it
+                continue
+            future_to_ping = {executor.submit(pingHost, ip, results, final): ip for ip in batch}
+            for future in concurrent.futures.as_completed(future_to_ping):
+                node = future_to_ping[future]
+                try:
+                    data = future.result()
+                except Exception as e:
+                    say('%s generated an exception: %s' % (node, e))
+    if ownEngine:
+        engine.close()
+    metrics.addPhase('ping', time.perf_counter() - started)
+    say("[+]Ping sweep complete\n")
 
 ##############################################################################################################
-# Test all tcp ports
+# Test all tcp ports on one or more hosts. Ports go through the connect engine a few at a time, so only the
+# connections in flight are held in memory, and the hosts are interleaved port by port under one limit
 ##############################################################################################################
-def tcpSweep(ipFreeList, index, portFreeList, portFoundList):
+def tcpSweep(hosts, results, maxInFlight=1000, rtt=None, governor=None):
     start = time.time()
-    print('\nDoing full scan on ' + ipFreeList[int(index)-1])
-    portsToScan = range(1,65535)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=200) as executor:
-        future_to_port = {executor.submit(scanPort, ipFreeList[int(index)-1], portToScan, ipFreeList, portFound): portToScan for portToScan in portsToScan}
-        for future in concurrent.futures.as_completed(future_to_port):
-            portToScan = future_to_port[future]
-            try:
-                data = future.result()
-            except Exception as e:
-                print('%s generated an exception: %s' % (host, e))
-                
+    print('\nDoing full scan on ' + ', '.join(hosts))
+
+    def recordPort(ip, port, result):
+        if result == 0:
+            results.addPort(ip, port)
+            results.markFound(ip, 'tcp')
+
+    engine = ConnectEngine(maxInFlight, rtt, governor, stage='deep')
+    engine.run(((ip, port) for port in range(1, 65536) for ip in hosts), recordPort)
     end = time.time()
+    metrics.addPhase('deep', end - start)
     
     print('Time taken in seconds : ', end - start)
-    
-    if(len(portFound)==0):
-        print('\n\n[+]No open ports found')
-    else:
-        print('[!!!]Got a reply on ' + str(len(portFound)) + ', try another IP[!!!]')
+    print('[+]Made ' + str(engine.probes) + ' connections (' + str(round(engine.rate())) + ' probes/sec)')
+
+    for ip in hosts:
+        openPorts = results.openPorts(ip)
+        if len(openPorts) == 0:
+            print('\n[+]' + ip + ' - No open ports found')
+        else:
+            print('\n[!!!]' + ip + ' - Got a reply on ' + str(len(openPorts)) + ' port(s), try another IP[!!!]')
+            print('     ' + ', '.join(str(port) for port in openPorts))
             
 ##############################################################################################################
-# Pings the host with one ICMP packet, if the text "Lost = 0" is present, the IP is added to the found list
-# otherwise it's added to the free list
+# Pings the host with the system ping command, up to four times. The first reply marks the IP as found,
+# if none come back it's marked as free
 ##############################################################################################################
-def pingHost(ipAddx, pingFree, pingFound):
+pingFailures = ['request timed out', 'destination host unreachable', 'general failure', 'network is unreachable']
+
+def pingHost(ipAddx, results, final=False):
     #output = subprocess.run(["ping", "-n", "1", "-w", "100", ipAddx], stdout=subprocess.PIPE)
     #output = subprocess.run(["ping", "-n", "3", ipAddx], stdout=subprocess.PIPE) 
     #if str(output).find("Lost = 0") >= 0:
 
-    confidence = 0
+    countFlag = '-n' if os.name == 'nt' else '-c'  #-n is the packet count on windows, everywhere else it's -c
+    waitFlag = ['-W', '1']          #give up on a reply after a second
+    if os.name == 'nt':
+        waitFlag = ['-w', '1000']   #milliseconds on windows
+    elif sys.platform == 'darwin' or 'bsd' in sys.platform:
+        waitFlag = ['-W', '1000']   #and on macOS and the BSDs
 
     for x in range(4):
-        result = subprocess.run(["ping", "-n", "1", ipAddx], stdout=subprocess.PIPE)
-        #There's some placeholder code here that does nothing but filter responses
-        if "request timed out" in str(result.stdout).lower():
-            confidence=confidence+0
-        elif "destination host unreachable" in str(result.stdout).lower():
-            confidence=confidence+0
-        elif "general failure" in str(result.stdout).lower():
-            confidence=confidence+0
-        elif "network is unreachable" in str(result.stdout).lower():
-            confidence=confidence+0
+        sent = time.monotonic()
+        result = subprocess.run(["ping", countFlag, "1"] + waitFlag + [ipAddx], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output = str(result.stdout).lower()
+        #windows ping exits zero for some failures, so the output is still filtered
+        if result.returncode == 0 and not any(failure in output for failure in pingFailures):
+            metrics.probe('icmp', 0, time.monotonic() - sent)   #includes the process spawn
+            results.markFound(ipAddx, 'icmp')
+            return      #one reply is enough, don't ask again
+
+    metrics.count('icmp', 'timeout')
+    results.markFree(ipAddx)
+    if final:
+        results.markSettled(ipAddx)
+
+##############################################################################################################
+# Build an ICMP echo request, the checksum is the ones' complement of the ones' complement sum of the packet
+##############################################################################################################
+def icmpChecksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data)//2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def icmpEcho(ident, seq, payload=b'annoyedipscanner'):
+    header = struct.pack('!BBHHH', 8, 0, 0, ident, seq)
+    return struct.pack('!BBHHH', 8, 0, icmpChecksum(header + payload), ident, seq) + payload
+
+##############################################################################################################
+# In-process ICMP echo engine. On linux an unprivileged SOCK_DGRAM ICMP socket is used when the user is in
+# net.ipv4.ping_group_range, otherwise a raw socket. Echoes for the whole range go out from that one socket,
+# replies are matched back to the host by id/seq and a host that replied is not probed again. Up to 'tries'
+# rounds are spread over one 'timeout' window
+##############################################################################################################
+class PingEngine:
+    def __init__(self, timeout=1.0, tries=4):
+        self.timeout = timeout              #seconds to wait for the whole sweep
+        self.tries = tries                  #echoes sent to a host that hasn't replied yet
+        self.ident = os.getpid() & 0xffff   #echo id, the kernel rewrites this on SOCK_DGRAM sockets
+        self.raw = False
+        self.sock = None
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        except OSError:
+            try:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+                self.raw = True
+            except OSError:
+                self.sock = None
+        if self.sock != None:
+            self.sock.setblocking(False)
+
+    def available(self):
+        return self.sock != None
+
+    def close(self):
+        if self.sock != None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, ip, seq):
+        packet = icmpEcho(self.ident, seq)
+        while True:
+            try:
+                self.sock.sendto(packet, (ip, 0))
+                return
+            except (BlockingIOError, InterruptedError):
+                select.select([], [self.sock], [], self.timeout)   #socket buffer is full, wait for it to drain
+            except OSError:
+                return      #unreachable and friends, the host just won't reply
+
+    #match one reply to the host that's waiting on it, returns the round trip time or None
+    def matchReply(self, data, ip, waiting):
+        if len(data) > 0 and data[0] >> 4 == 4:
+            data = data[(data[0] & 0x0f) * 4:]  #raw sockets, and datagram ones on macOS, hand us the IP header too
+        if len(data) < 8:
+            return None
+        icmpType, code, checksum, ident, seq = struct.unpack('!BBHHH', data[:8])
+        if icmpType != 0 or ip not in waiting:
+            return None
+        if self.raw and ident != self.ident:    #raw sockets see every ICMP packet, not only ours
+            return None
+        index, sent = waiting[ip]
+        probe = (seq - index * self.tries) & 0xffff
+        if probe >= len(sent):
+            return None
+        del waiting[ip]
+        return time.time() - sent[probe]
+
+    #read replies until 'wait' seconds have passed or nobody is waiting anymore
+    def readReplies(self, waiting, callback, wait):
+        deadline = time.time() + wait
+        while len(waiting) > 0:
+            left = max(deadline - time.time(), 0)
+            ready, x, y = select.select([self.sock], [], [], left)
+            if not ready:
+                break
+            while True:
+                try:
+                    data, addr = self.sock.recvfrom(2048)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    continue    #a queued ICMP error, skip it
+                rtt = self.matchReply(data, addr[0], waiting)
+                if rtt != None:
+                    callback(addr[0], rtt)
+
+    #ping every IP, callback(ip, rtt) is called for each reply, returns the IPs that never replied
+    def sweep(self, ips, callback):
+        waiting = {}    #ip -> (index of the host, send time of each echo)
+        for index, ip in enumerate(ips):
+            waiting[ip] = (index, [])
+        interval = self.timeout / self.tries
+
+        for probe in range(self.tries):
+            for ip in list(waiting):
+                if ip not in waiting:           #replied while we were sending
+                    continue
+                index, sent = waiting[ip]
+                sent.append(time.time())
+                self.send(ip, (index * self.tries + probe) & 0xffff)
+                self.readReplies(waiting, callback, 0)
+            self.readReplies(waiting, callback, interval)
+        return list(waiting)
+
+    #the pipeline needs a loop that can watch the socket, windows' default proactor loop can't
+    def watchable(self, loop):
+        return self.available() and isinstance(loop, asyncio.SelectorEventLoop)
+
+    #send from inside the event loop, a full socket buffer is waited out without holding up the loop
+    async def sendAsync(self, ip, seq):
+        loop = asyncio.get_running_loop()
+        packet = icmpEcho(self.ident, seq)
+        while True:
+            try:
+                self.sock.sendto(packet, (ip, 0))
+                return
+            except (BlockingIOError, InterruptedError):
+                drained = loop.create_future()
+                loop.add_writer(self.sock, lambda: drained.done() or drained.set_result(None))
+                try:
+                    await drained
+                finally:
+                    loop.remove_writer(self.sock)
+            except OSError:
+                return      #unreachable and friends, the host just won't reply
+
+    #the same rounds run inside an event loop with every host on its own clock. A host holds a slot of 'budget'
+    #from its first echo until it's decided, onReply(ip, rtt) and onSilent(ip) are called the moment it is
+    async def sweepAsync(self, ips, onReply, onSilent, budget):
+        loop = asyncio.get_running_loop()
+        waiting = {}    #ip -> (index of the host, send time of each echo), oldest first
+        interval = self.timeout / self.tries
+        sending = True
+        sendLock = asyncio.Lock()   #one sender at a time waits on a full buffer
+
+        async def send(ip, seq):
+            async with sendLock:
+                await self.sendAsync(ip, seq)
+
+        def readable():
+            while True:
+                try:
+                    data, addr = self.sock.recvfrom(2048)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError:
+                    continue    #a queued ICMP error, skip it
+                rtt = self.matchReply(data, addr[0], waiting)
+                if rtt != None:
+                    budget.release()
+                    onReply(addr[0], rtt)
+
+        async def tick():
+            while sending or len(waiting) > 0:
+                await asyncio.sleep(interval / 4)
+                now = time.time()
+                for ip in list(waiting):
+                    if ip not in waiting:   #replied while we were sending
+                        continue
+                    index, sent = waiting[ip]
+                    if now - sent[0] >= self.timeout:
+                        del waiting[ip]
+                        budget.release()
+                        onSilent(ip)
+                    elif len(sent) < self.tries and now - sent[0] >= interval * len(sent):
+                        sent.append(now)
+                        await send(ip, (index * self.tries + len(sent) - 1) & 0xffff)
+
+        loop.add_reader(self.sock, readable)
+        ticker = asyncio.ensure_future(tick())
+        try:
+            for index, ip in enumerate(ips):
+                await budget.acquire()
+                waiting[ip] = (index, [time.time()])
+                await send(ip, (index * self.tries) & 0xffff)
+            sending = False
+            await ticker
+        finally:
+            ticker.cancel()
+            loop.remove_reader(self.sock)
+
+##############################################################################################################
+# Round trip time estimates per host, smoothed the way TCP does it (RFC 6298). Hosts we haven't heard from
+# yet use the estimate for their /24, or for the whole network when nothing in it has answered, so a silent
+# host on a slow link still gets a slow link timeout. Borrowed estimates never go below 'minUnseen', a LAN
+# answering in microseconds says nothing about a host behind a router
+##############################################################################################################
+class RttEstimator:
+    def __init__(self, initial=0.25, minTimeout=0.05, maxTimeout=2.0, minUnseen=0.1):
+        self.initial = initial          #timeout to use before we've seen any reply at all
+        self.minTimeout = minTimeout
+        self.maxTimeout = maxTimeout
+        self.minUnseen = minUnseen      #the least a host without samples of its own gets
+        self.hosts = {}                 #ip -> [smoothed rtt, rtt variation]
+        self.subnets = {}               #subnet -> the same pair over its hosts
+        self.network = None             #the same pair over every sample
+
+    def smooth(self, estimate, sample):
+        if estimate == None:
+            return [sample, sample / 2]
+        srtt, rttvar = estimate
+        rttvar = 0.75 * rttvar + 0.25 * abs(srtt - sample)
+        srtt = 0.875 * srtt + 0.125 * sample
+        return [srtt, rttvar]
+
+    def update(self, ip, sample):
+        subnet = subnetOf(ip)
+        self.hosts[ip] = self.smooth(self.hosts.get(ip), sample)
+        self.subnets[subnet] = self.smooth(self.subnets.get(subnet), sample)
+        self.network = self.smooth(self.network, sample)
+
+    def timeout(self, ip):
+        estimate = self.hosts.get(ip)
+        if estimate != None:
+            return min(max(estimate[0] + 4 * estimate[1], self.minTimeout), self.maxTimeout)
+        estimate = self.subnets.get(subnetOf(ip), self.network)
+        if estimate == None:
+            return self.initial
+        return min(max(estimate[0] + 4 * estimate[1], self.minUnseen), self.maxTimeout)
+
+##############################################################################################################
+# Global probes per second governor, a token bucket whose rate goes up a step after every quiet window of
+# probes and is cut in half when the share of timeouts in a window jumps above the usual share. Scanning
+# for free IPs times out a lot by nature so the usual share is learned as the scan goes
+##############################################################################################################
+class RateGovernor:
+    def __init__(self, rate=10000, minRate=100, window=200):
+        self.rate = float(rate)         #probes per second we're allowed right now
+        self.step = rate / 10           #how much a quiet window adds
+        self.maxRate = rate * 4
+        self.minRate = minRate
+        self.window = window            #probes per decision
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.sent = 0
+        self.timeouts = 0
+        self.usual = None               #running share of probes that time out
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.last) * self.rate, max(self.rate / 10, 1))  #burst of 100ms at most
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def record(self, timedOut):
+        self.sent += 1
+        if timedOut:
+            self.timeouts += 1
+        if self.sent < self.window:
+            return
+        share = self.timeouts / self.sent
+        if self.usual != None and share > self.usual * 1.5 + 0.1:
+            self.rate = max(self.rate / 2, self.minRate)            #timeouts spiked, back off
         else:
-            confidence=confidence+1
+            self.rate = min(self.rate + self.step, self.maxRate)
+            self.usual = share if self.usual == None else 0.8 * self.usual + 0.2 * share
+        self.sent = 0
+        self.timeouts = 0
+
+##############################################################################################################
+# Non-blocking connect engine, every probe shares one event loop and one global limit on connections in flight
+# a probe returns the same values as connect_ex, zero when the port answered otherwise an errno. The timeout
+# comes from the host's round trip estimate, a timed out probe is asked again with double the timeout
+##############################################################################################################
+class ConnectEngine:
+    def __init__(self, maxInFlight=1000, rtt=None, governor=None, retries=1, stage='tcp'):
+        self.maxInFlight = maxInFlight  #the most connections we'll have open at any one time
+        self.stage = stage              #what the probes are counted under
+        self.rtt = rtt if rtt != None else RttEstimator()
+        self.governor = governor if governor != None else RateGovernor()
+        self.retries = retries          #extra tries for a probe that timed out
+        self.probes = 0                 #connects that finished in the last run, retries included
+        self.elapsed = 0.0              #wall time of the last run
+        self.inFlight = {}              #ip -> probe tasks outstanding to it
+        self.cancelled = set()          #probe tasks cancel() dropped, anything else cancelled is the caller's
+
+    async def connect(self, ip, port, timeout):
+        loop = asyncio.get_running_loop()
+        sock = None
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)   #out of fds is this probe's problem, not the scan's
+            sock.setblocking(False)
+            await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), timeout)
+            return 0
+        except asyncio.TimeoutError:
+            return errno.EAGAIN         #connect_ex reports a timed out connect as EAGAIN
+        except OSError as e:
+            return e.errno if e.errno else errno.EIO
+        finally:
+            if sock != None:
+                sock.close()
+
+    async def probe(self, ip, port):
+        timeout = self.rtt.timeout(ip)
+        for attempt in range(self.retries + 1):
+            await self.governor.acquire()
+            sent = time.monotonic()
+            result = await self.connect(ip, port, timeout)
+            elapsed = time.monotonic() - sent
+            metrics.probe(self.stage, result, elapsed)
+            self.probes += 1            #counted per connect like the metrics, a retry is another connect
+            if result != errno.EAGAIN:
+                if result == 0 or result == errno.ECONNREFUSED:     #a SYN-ACK or a RST, either way it's a round trip
+                    self.rtt.update(ip, elapsed)
+                self.governor.record(False)
+                return result
+            self.governor.record(True)
+            timeout = min(timeout * 2, self.rtt.maxTimeout)
+        return result
+
+    #a probe that cancel() can reach, returns None when it was cancelled
+    async def tracked(self, ip, port):
+        task = asyncio.ensure_future(self.probe(ip, port))
+        self.inFlight.setdefault(ip, set()).add(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task not in self.cancelled:      #it's us being cancelled, not just the probe
+                raise
+            return None
+        finally:
+            self.cancelled.discard(task)
+            probes = self.inFlight[ip]
+            probes.discard(task)
+            if len(probes) == 0:
+                del self.inFlight[ip]
+
+    async def worker(self, targets, callback):
+        for ip, port in targets:        #every worker pulls from the same iterator, so nothing is queued up front
+            result = await self.tracked(ip, port)
+            if result != None:
+                callback(ip, port, result)
+
+    #drop every connect still outstanding to a host, for when one answer is all we needed
+    def cancel(self, ip):
+        for task in self.inFlight.get(ip, ()):
+            if task.cancel():
+                self.cancelled.add(task)
 
-    if (confidence>0):
-        pingFound.append(ipAddx)
+    async def runAll(self, targets, callback):
+        targets = iter(targets)
+        await asyncio.gather(*(self.worker(targets, callback) for x in range(self.maxInFlight)))
+
+    def run(self, targets, callback):
+        self.probes = 0
+        start = time.time()
+        asyncio.run(self.runAll(targets, callback))
+        self.elapsed = time.time() - start
+
+    def rate(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.probes / self.elapsed
+
+##############################################################################################################
+# Scan a list of ports on the hosts still marked free, all of them at once through the connect engine
+# the store is checked as the scan goes, a host stops at its first open port and the connects still out to
+# it are cancelled. With learned port orders every /24 goes through the ports in its own order
+##############################################################################################################
+def portOrders(ports, learned):
+    orders = {}     #subnet -> ports in the order that subnet answers on
+
+    def portOrder(ip):
+        if not learned:
+            return ports
+        subnet = subnetOf(ip)
+        if subnet not in orders:
+            orders[subnet] = orderPorts(ports, learned.get(subnet, []))
+        return orders[subnet]
+    return portOrder
+
+def scanPorts(hosts, ports, results, maxInFlight=1000, rtt=None, governor=None, learned=None, say=print):
+    portOrder = portOrders(ports, learned)
+    answered = {}   #ip -> probes back so far, for the hosts still being probed
+
+    def recordResult(ip, port, result):
+        if result == 0 and results.isFree(ip):
+            results.addPort(ip, port)
+            results.markFound(ip, 'tcp')
+            engine.cancel(ip)           #one open port is all it takes
+        answered[ip] = answered.get(ip, 0) + 1
+        if answered[ip] == len(ports):
+            del answered[ip]
+            results.markSettled(ip)     #that was its last probe
+
+    engine = ConnectEngine(maxInFlight, rtt, governor)
+    if learned:
+        probes = ((ip, portOrder(ip)[rank]) for rank in range(len(ports)) for ip in hosts if results.isFree(ip))
     else:
-        pingFree.append(ipAddx)
+        probes = ((ip, port) for port in ports for ip in hosts if results.isFree(ip))   #walk port by port so no single host gets hammered
+    engine.run(probes, recordResult)
+    metrics.addPhase('tcp', engine.elapsed)
+    say('[+]Made ' + str(engine.probes) + ' connections in ' + str(round(engine.elapsed, 2)) + ' seconds (' + str(round(engine.rate())) + ' probes/sec)\n')
 
-##################################################
-# Scan ports in a list using multiple threads
-##################################################
-def scanPorts(ip, ports, tcpFree, tcpFound):
-    threads = []
-    
-    for port in ports:
-        thread = threading.Thread(target=scanPort, args=(ip, port, tcpFound, tcpFree))
-        threads.append(thread)
-        thread.start()
+#run a coroutine to the end on a loop of our own, whatever it leaves behind is cancelled like asyncio.run does
+def runOn(loop, coroutine):
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if len(pending) > 0:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
 
-    for thread in threads:
-        thread.join()
-        
-##################################################
-# Function to scan a single port
-##################################################
-def scanPort(ip, port, tcpFound, tcpFree):
+##############################################################################################################
+# Ping and port scan as one pipeline. A host goes into the TCP queue the moment its echoes go unanswered,
+# while the rest of the block is still being pinged, and echoes waiting on a reply count against the same
+# limit as connects in flight. The hosts in the queue take turns a port at a time, and a host stops at its
+# first open port. Without an ICMP socket, or an event loop that can watch one, it's the ping sweep followed
+# by the port scan. The engines and loop can be handed in to be used again, what's opened here is closed here
+##############################################################################################################
+def scanPipelined(hosts, ports, results, maxInFlight=1000, rtt=None, governor=None, learned=None, pinger=None, engine=None, loop=None, say=print):
+    ownPinger = pinger == None
+    ownLoop = loop == None
+    pinger = PingEngine() if ownPinger else pinger
+    loop = asyncio.new_event_loop() if ownLoop else loop
+    engine = ConnectEngine(maxInFlight, rtt, governor) if engine == None else engine
+
+    def release():
+        if ownPinger:
+            pinger.close()
+        if ownLoop:
+            loop.close()
+
+    if not pinger.watchable(loop):
+        try:
+            pingSweep(hosts, results, engine.rtt, final=len(ports) == 0, engine=pinger, say=say)
+        finally:
+            release()
+        if len(ports) > 0:
+            scanPorts(hosts, ports, results, maxInFlight, engine.rtt, engine.governor, learned, say)
+        return
+
+    say("\n[+]Starting ping sweep, hosts that don't reply go straight to the port scan\n")
+    engine.probes = 0
+    portOrder = portOrders(ports, learned)
+    queue = collections.deque()     #[ip, its ports, next port, probes out] for every host with ports left to try
+    silent = 0
+
+    def recordReply(ip, seconds):
+        metrics.probe('icmp', 0, seconds)
+        results.markFound(ip, 'icmp')
+        engine.rtt.update(ip, seconds)
+
+    def recordSilent(ip):
+        nonlocal silent
+        silent += 1
+        metrics.count('icmp', 'timeout')
+        results.markFree(ip)
+        if len(ports) > 0:
+            queue.append([ip, portOrder(ip), 0, 0])
+            ready.set()
+        else:
+            results.markSettled(ip)     #no ports to try, the ping was the last word
+
+    def nextProbe():
+        while len(queue) > 0:
+            entry = queue.popleft()
+            ip, order, rank, out = entry
+            if rank >= len(order) or not results.isFree(ip):
+                continue
+            entry[2] += 1
+            entry[3] += 1
+            if entry[2] < len(order):
+                queue.append(entry)     #back of the line, the next host gets the next probe
+            return entry, order[rank]
+        return None
+
+    async def worker():
+        while True:
+            target = nextProbe()
+            if target == None:
+                if not pinging:
+                    return
+                ready.clear()
+                await ready.wait()
+                continue
+            entry, port = target
+            ip = entry[0]
+            async with budget:
+                result = await engine.tracked(ip, port)
+            entry[3] -= 1
+            if result == 0 and results.isFree(ip):
+                results.addPort(ip, port)
+                results.markFound(ip, 'tcp')
+                engine.cancel(ip)       #one open port is all it takes
+            elif entry[2] == len(entry[1]) and entry[3] == 0:
+                results.markSettled(ip) #its last probe is back and nothing answered
+
+    async def run():
+        nonlocal pinging, budget, ready
+        budget = asyncio.Semaphore(maxInFlight)     #echoes waiting and connects in flight, together
+        ready = asyncio.Event()                     #set when the queue gets a host or the sweep is done
+        workers = [asyncio.ensure_future(worker()) for x in range(maxInFlight)]
+        try:
+            await pinger.sweepAsync(hosts, recordReply, recordSilent, budget)
+        finally:
+            pinging = False
+            ready.set()
+        await asyncio.gather(*workers)
+
+    budget = None
+    ready = None
+    pinging = True
+    started = time.perf_counter()
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(0.1)
-        result = sock.connect_ex((ip, port))
-        if result == 0:
-            if ip not in tcpFound:  #don't add an IP that's already been added
-                tcpFound.append(ip) #if it's the first detection add it
-            if ip in tcpFree:
-                tcpFree.remove(ip)
-        sock.close()
-    except Exception as e:
-        print(f"Error scanning port {port}: {e}")
+        runOn(loop, run())
+    finally:
+        release()
+    elapsed = time.perf_counter() - started
+    metrics.addPhase('pipeline', elapsed)
+    say('[+]' + str(silent) + ' hosts did not respond to ICMP requests')
+    if len(ports) > 0:
+        say('[+]Made ' + str(engine.probes) + ' connections in ' + str(round(elapsed, 2)) + ' seconds (' + str(round(engine.probes / elapsed if elapsed > 0 else 0)) + ' probes/sec)\n')
+
+##############################################################################################################
+# Size the connections in flight to the open file limit. The soft limit is raised to the hard one when we're
+# allowed, a few fds are kept back for sockets, files and the ICMP engine
+##############################################################################################################
+def fdBudget(requested, reserve=64):
+    if resource == None:
+        return requested
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1048576
+    if soft == resource.RLIM_INFINITY:
+        soft = hard
+    if soft < min(hard, requested + reserve):
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, requested + reserve), hard))
+            soft = min(hard, requested + reserve)
+        except (ValueError, OSError):
+            pass
+    return max(1, min(requested, soft - reserve))
+
+##############################################################################################################
+# Sharded scanning, every worker process keeps its own round trip estimates, rate governor and engines for
+# its whole life. The connection and rate limits are split evenly between them, and each share is capped by
+# the worker's own fd limit. The parent hands each one a slice of a block and merges what comes back into
+# its store, so checkpoints, records and the report work the same as with one process
+##############################################################################################################
+shard = {}      #the worker's own state, set up once per process
+
+def startShard(maxInFlight, rate, learned):
+    shard['maxInFlight'] = fdBudget(maxInFlight)
+    shard['learned'] = learned
+    shard['engine'] = ConnectEngine(shard['maxInFlight'], RttEstimator(), RateGovernor(rate))
+    shard['pinger'] = PingEngine()
+    shard['loop'] = asyncio.new_event_loop()
+
+def scanShard(hosts, ports, pingOnly):
+    addresses = [int(ipaddress.IPv4Address(ip)) for ip in hosts]
+    results = ResultStore([(address, address) for address in addresses])
+    scanPipelined(hosts, ports if pingOnly == False else [], results, shard['maxInFlight'], learned=shard['learned'],
+                  pinger=shard['pinger'], engine=shard['engine'], loop=shard['loop'], say=noPrint)   #the parent does the talking
+    found = [(ip, results.probe(ip), results.openPorts(ip)) for ip in results.foundHosts()]
+    counts = metrics.export()
+    metrics.reset()
+    return found, list(results.freeHosts()), counts
+
+def startShards(shards, maxInFlight, rate, learned=None):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=shards, initializer=startShard, initargs=(max(maxInFlight // shards, 1), max(rate / shards, 1), learned))
+
+def scanSharded(pool, shards, block, ports, pingOnly, results):
+    started = time.perf_counter()
+    size = math.ceil(len(block) / shards)
+    futures = [pool.submit(scanShard, block[start:start+size], ports, pingOnly) for start in range(0, len(block), size)]
+    for future in futures:
+        found, free, counts = future.result()
+        metrics.merge(counts)
+        for ip, probe, openPorts in found:
+            for port in openPorts:
+                results.addPort(ip, port)
+            results.markFound(ip, probe)
+        for ip in free:
+            results.markFree(ip)
+            results.markSettled(ip)     #the worker is done with its whole slice
+    metrics.addPhase('shards', time.perf_counter() - started)
+
+##############################################################################################################
+# The scanner as something to import. One Scanner keeps its ICMP socket, connect engine, event loop, round
+# trip estimates, rate governor and worker processes from scan to scan, so only the first one pays for them.
+# Bad targets or ports raise ValueError, nothing in here quits or asks for input, and progress is only
+# printed when 'verbose' is set
+##############################################################################################################
+class Scanner:
+    def __init__(self, ports='fast', maxInFlight=1000, rate=10000, shards=1, learned=None, blockSize=4096, verbose=False):
+        self.ports = portSet(ports) if ports == None or isinstance(ports, str) else orderPorts(ports)
+        self.maxInFlight = fdBudget(maxInFlight)
+        self.rtt = RttEstimator()
+        self.governor = RateGovernor(rate)
+        self.learned = learned          #per subnet port orders, see ScanState.portOrders
+        self.shards = shards
+        self.pool = startShards(shards, maxInFlight, rate, learned) if shards > 1 else None
+        self.pinger = PingEngine() if self.pool == None else None   #the workers have their own
+        self.engine = ConnectEngine(self.maxInFlight, self.rtt, self.governor)
+        self.loop = asyncio.new_event_loop()
+        self.say = print if verbose else noPrint
+        self.blockSize = blockSize * max(shards, 1)
+        self.block = []                 #the addresses being scanned right now
+        self.lock = threading.Lock()    #one scan at a time, they share the loop
+        self.stopping = threading.Event()   #set to end the scan running now after its current block
+
+    #ask a scan that's running to stop after the block it's on, the results it hands back are partial
+    def stop(self):
+        self.stopping.set()
+
+    def close(self):
+        self.stop()
+        with self.lock:
+            if self.pool != None:
+                self.pool.shutdown()
+                self.pool = None
+            if self.pinger != None:
+                self.pinger.close()
+                self.pinger = None
+            if not self.loop.is_closed():
+                self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #scan hosts into a result store a block at a time, onBlock(block) is called after every block
+    def scan(self, hosts, results, pingOnly=False, onBlock=None):
+        hosts = iter(hosts)
+        with self.lock:
+            while not self.stopping.is_set() and len(block := takeBatch(hosts, self.blockSize)) > 0:
+                self.block = block
+                if self.pool != None:
+                    scanSharded(self.pool, self.shards, block, self.ports, pingOnly, results)
+                    self.say('[+]Scanned ' + str(len(block)) + ' addresses, ' + str(results.foundCount) + ' found so far')
+                else:
+                    scanPipelined(block, self.ports if pingOnly == False else [], results, self.maxInFlight, learned=self.learned,
+                                  pinger=self.pinger, engine=self.engine, loop=self.loop, say=self.say)
+                if onBlock != None:
+                    onBlock(block)
+            self.block = []
+        return results
+
+    #scan targets given the way -s and -x take them and return the result store
+    def sweep(self, targets, excludes=None, first=1, last=255, pingOnly=False, neighbors=True):
+        if first > last or first < 0 or last > 255:
+            raise ValueError('the first host octet has to be between 0 and the last one, the last one 255 at most')
+        targets = parseTargets(targets, first, last)
+        excludes = parseTargets(excludes, first, last) if excludes != None else []
+        results = ResultStore(targets)
+        hosts = targetHosts(targets, excludes)
+        if neighbors:
+            hosts = skipNeighbors(hosts, neighborHosts(), results)
+        return self.scan(hosts, results, pingOnly)
+
+##############################################################################################################
+# Daemon mode, the index of free addresses. Queries are answered from the last sweep that finished, and an
+# address that was handed out isn't handed out again for 'hold' seconds, by then a sweep should have seen it
+# in use. One query per line on the socket, one JSON line back:
+#   free N [targets]    - up to N free addresses, from the targets if given, same format as -s
+#   status              - sweeps done, when the last one finished and what it found
+##############################################################################################################
+class FreeIndex:
+    def __init__(self, first=1, last=255, hold=300):
+        self.first = first              #host octets for A.B.C targets in queries
+        self.last = last
+        self.hold = hold
+        self.results = None             #the store of the last finished sweep
+        self.swept = None               #when it finished
+        self.sweeps = 0
+        self.held = {}                  #ip -> when it was handed out
+        self.lock = threading.Lock()
+
+    def update(self, results):
+        with self.lock:
+            now = time.time()
+            self.results = results
+            self.swept = now
+            self.sweeps += 1
+            self.held = {ip: when for ip, when in self.held.items() if now - when < self.hold}
+
+    def take(self, count, targets=None):
+        ranges = parseTargets(targets, self.first, self.last) if targets != None else None
+        with self.lock:
+            if self.results == None:
+                raise LookupError('no sweep has finished yet')
+            now = time.time()
+            picked = []
+            for ip in self.results.freeHosts() if ranges == None else self.results.freeIn(ranges):
+                if len(picked) == count:
+                    break
+                if now - self.held.get(ip, 0) < self.hold:
+                    continue
+                self.held[ip] = now
+                picked.append(ip)
+            return picked
+
+    def answer(self, line):
+        words = line.split()
+        try:
+            if len(words) in (2, 3) and words[0] == 'free':
+                if not words[1].isdigit():
+                    raise ValueError(words[1] + ' is not a count')
+                return {'free': self.take(int(words[1]), words[2] if len(words) == 3 else None), 'swept': self.swept}
+            if words == ['status']:
+                results = self.results
+                return {'sweeps': self.sweeps, 'swept': self.swept,
+                        'found': results.foundCount if results != None else 0,
+                        'free': results.freeCount if results != None else 0}
+            return {'error': 'expected free N [targets] or status'}
+        except (ValueError, LookupError) as e:
+            return {'error': str(e)}
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            reply = self.server.index.answer(line.decode(errors='replace'))
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+            self.wfile.flush()
+
+##############################################################################################################
+# Run as a daemon, one thread sweeps the targets every 'interval' seconds while the socket is served. The
+# socket is only open to its owner. A socket left over from an earlier daemon is replaced, one that a daemon
+# still answers on is an error. SIGTERM and ctrl-c both stop it after the block being scanned and take the
+# socket away
+##############################################################################################################
+def serveDaemon(scanner, path, targets, excludes, first, last, pingOnly, interval, neighbors=True):
+    index = FreeIndex(first, last, interval)
+    stopped = threading.Event()
+
+    def sweepLoop():
+        while not stopped.is_set():
+            started = time.time()
+            try:
+                results = scanner.sweep(targets, excludes, first, last, pingOnly, neighbors)
+            except Exception as e:
+                print('[!]Sweep failed: ' + str(e))
+            else:
+                if scanner.stopping.is_set():
+                    return      #cut short, the index keeps the last whole sweep
+                index.update(results)
+                print('[+]Sweep ' + str(index.sweeps) + ' took ' + str(round(time.time() - started, 2)) + ' seconds, ' + str(results.foundCount) + ' found, ' + str(results.freeCount) + ' potentially free')
+            stopped.wait(max(interval - (time.time() - started), 0))
+
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)     #nobody answers on it, it's left over
+        else:
+            raise OSError(errno.EADDRINUSE, 'a daemon is already answering on ' + path)
+        finally:
+            probe.close()
+    mask = os.umask(0o077)      #the socket is created private, never open to anyone else even for a moment
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, DaemonHandler)
+    finally:
+        os.umask(mask)
+    server.daemon_threads = True
+    server.index = index
+    print('[+]Answering queries on ' + path + ', sweeping every ' + str(interval) + ' seconds')
+    sweeper = threading.Thread(target=sweepLoop, daemon=True)
+    sweeper.start()
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt     #stop the same way as ctrl-c
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\n[+]Stopping')
+    finally:
+        stopped.set()
+        scanner.stop()
+        server.server_close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        sweeper.join()
+        scanner.close()
 
 ##################################################
 # Function prints a table of free IPs
@@ -296,53 +1757,77 @@ def freePrint(ipPrint, title):
     print(' ')
 
 ##############################################################################################################
-# Ask if the user wants a full port scan
+# Ask if the user wants a full port scan, any number of indexes can be picked, ex: 1,4,7-9
+# returns the list of picked indexes, empty if the user wants to quit
 ##############################################################################################################
 def pickListDoFullScan(maxVal):
     print('\n\nIf you want to do a full scan of all 65535 ports for, you can')
-    print('select an index for that scan. It may take several minutes.')
+    print('select one or more indexes for that scan, ex: 1,4,7-9. It may take several minutes.')
     
     compIndex = ''
     goodInput = False
     
     while(goodInput==False):
-        compIndex = input('\n[+]Enter the index to the left of the IP or 0 to quit: ')
+        compIndex = input('\n[+]Enter the indexes to the left of the IPs or 0 to quit: ').replace(' ', '')
+        picked = []
+        goodInput = True
 
-        if(compIndex.isdigit()==False):
-            print('\n[!]Value must be a digit between 1 and ' + str(maxVal) + ', or 0 to quit\n')
-        else:
-            if (int(compIndex) < 0 or int(compIndex) > maxVal):
+        for part in compIndex.split(','):
+            bounds = part.split('-')
+            if(len(bounds) > 2 or not all(bound.isdigit() for bound in bounds)):
+                print('\n[!]Values must be digits between 1 and ' + str(maxVal) + ', or 0 to quit\n')
+                goodInput = False
+                break
+            low, high = int(bounds[0]), int(bounds[-1])
+            if (low < 0 or high > maxVal or low > high):
                 print('\n[!]Value is out of range, must between 1 and ' + str(maxVal) + ', or 0 to quit\n')
+                goodInput = False
+                break
+            picked.extend(index for index in range(low, high+1) if index not in picked)
 
-            if((int(compIndex) <= maxVal) and (int(compIndex) >= 0)):
-                goodInput = True
-            
-    return compIndex
+    if 0 in picked:
+        return []
+    return picked
     
 ##############################################################################################################
 # Entry point
 ##############################################################################################################
 if __name__ == "__main__":
 #init and declare the variables we'll be using
+    args = vars(parser.parse_args())    #parsed here so the scanner can be imported without a command line
     start = time.time()     #for checking the amount of time a scan takes
-    subnet = args['s']      #the first three octets of an address separated with dots (1.2.3)
+    subnet = args['s']      #the targets, subnets of three octets (1.2.3), CIDR blocks, ranges or IPs
+    exclude = args['x']     #targets to leave out
     first = int(args['f'])  #the first host octet to start with
     last = int(args['l'])   #the last host octet to end with
     csvFile = args['a']     #CSV port input file
     newline = args['b']     #newline port input file
-    ipFound = []            #for recording found IPs
-    ipFree = []             #for recording potentially free IPs
     portsToScan = []        #the list of ports to scan
-    compIndexFullScan = ''  #list index of the IP to do a full scan on
-    portFound = []          #ips where the host was found by tcp connection
-    portFree = []           #ips where the host was not found by tcp connection
+    compIndexFullScan = []  #list indexes of the IPs to do a full scan on
     portFile = ''           #when a user uses a file with a list of ports
     fileType = ''           #c = csv, n = ports are listed one per line
+    statePath = args['state'] #where results are kept between runs
+    state = None            #the open scan state, if there is one
+    shards = (os.cpu_count() or 1) if args['shards'] == 'auto' else int(args['shards'])  #worker processes
+    scanner = None          #engines, estimates and worker processes, kept for the whole run
+    learned = None          #per subnet port orders learned from earlier runs
+    maxInFlight = fdBudget(int(args['c']))  #connections in flight, no more than the fd limit allows
+    writer = None           #streams a record per address when --batch or --output is given
+    output = sys.stdout     #where the records go
+
+    #in batch mode stdout is for records, everything else goes to stderr
+    if args['batch'] and (args['output'] == None or args['output'] == '-'):
+        sys.stdout = sys.stderr
 
     #Part 1 - do the tasks that are one-time tasks first
     printHeader()                   #print a short header
-    parmChecks(first, last, subnet, csvFile, newline) #check the input parameters, ensure they're all in bounds
-    hosts = range(first,last+1)     #build the range of hosts in the host octet
+    parmChecks(first, last, subnet, exclude, csvFile, newline) #check the input parameters, ensure they're all in bounds
+    targets = parseTargets(subnet, first, last)                     #ranges of addresses to scan
+    excludes = parseTargets(exclude, first, last) if exclude != None else []
+    print('[+]Scanning ' + str(targetCount(targets, excludes)) + ' addresses')
+    if args['metrics'] != None:     #written however the run ends
+        atexit.register(metrics.write, args['metrics'])
+    results = ResultStore(targets)  #found/free state and open ports of every address
     if(csvFile != None):            #if the csv parameter was not present
         portFile = csvFile
         fileType = 'c'
@@ -351,22 +1836,101 @@ if __name__ == "__main__":
         fileType = 'n'
     if(newline == None and csvFile == None):
         portFile = None
-    subnet+='.'                     #add the last dot to the subnet for building IP addresses
-    portsToScan = buildPortList(args['p'], args['g'], first, last, portFile, fileType) #build port list with args
+    portsToScan = buildPortList(args['p'], args['g'], first, last, portFile, fileType, args['batch'] or args['daemon'] != None) #build port list with args
+    if maxInFlight < int(args['c']):
+        print('[!]The open file limit only allows ' + str(maxInFlight) + ' connections in flight')
+
+    #daemon mode sweeps over and over and answers queries until it's stopped
+    if args['daemon'] != None:
+        scanner = Scanner(portsToScan, maxInFlight, int(args['r']), shards)
+        try:
+            serveDaemon(scanner, args['daemon'], subnet, exclude, first, last, args['p'], float(args['interval']), args['no_neighbors'] == False)
+        except OSError as e:
+            scanner.close()
+            print('[!!!] Could not serve on ' + args['daemon'] + ': ' + str(e))
+        quit()
+    if args['batch'] or args['output'] != None:
+        if args['output'] != None and args['output'] != '-':
+            output = open(args['output'], 'w', buffering=65536, newline='')
+        writer = ResultWriter(output, args['format'], results)
+        results.listener = writer.found
+        results.settler = writer.free
+        writer.start()
+
+    #open the scan state, with --incremental or --resume the addresses that already have an answer are skipped
+    hosts = targetHosts(targets, excludes)
+    if statePath == None and (args['incremental'] or args['resume']):
+        statePath = 'annoyedipscanner.db'
+    if statePath != None:
+        state = ScanState(statePath)
+        resumed = state.startRun('|'.join([subnet, str(exclude), str(first), str(last)]), args['resume'])
+        if args['resume'] and not resumed:
+            print('[!]No interrupted scan of these targets to resume, starting a new one')
+        cutoff = 0
+        if args['incremental']:
+            cutoff = time.time() - float(args['ttl']) * 3600
+        if resumed:
+            cutoff = min(cutoff, state.started) if args['incremental'] else state.started
+        if args['incremental'] or resumed:
+            hosts = state.pendingHosts(targets, excludes, results, cutoff)
 
-    #Part 2 - see if we can quickly
-    #weed out hosts that reply to a ping sweep
-    pingSweep(subnet, hosts, ipFree, ipFound)
+    #ports that answered in a subnet before are tried there first
+    if state != None:
+        learned = state.portOrders()
 
+    if shards > 1:
+        print('[+]Scanning with ' + str(shards) + ' worker processes')
+    scanner = Scanner(portsToScan, maxInFlight, int(args['r']), shards, learned, verbose=True)
+
+    #addresses the kernel already knows are live never get a probe
+    if args['no_neighbors'] == False:
+        started = time.perf_counter()
+        neighbors = neighborHosts()
+        metrics.addPhase('neighbors', time.perf_counter() - started)
+        print('[+]Read ' + str(len(neighbors)) + ' live addresses from the local neighbor tables')
+        hosts = skipNeighbors(hosts, neighbors, results)
+
+    #Part 2 - a block of addresses at a time, see if we can quickly weed out hosts that reply to a ping sweep
     #if the -p switch was given on the command line the ping sweep is all that's we're doing to find live hosts
     #skip the TCP connection scan, otherwise call the scan ports function with the IPs to check
-    if args['p'] == False:
-        print("[+]Checking " + str(len(ipFree)) + " hosts that did not respond to ICMP requests\n")
-        for ipAdx in ipFree:
-            scanPorts(ipAdx, portsToScan, ipFree, ipFound)
+    #with a scan state every finished block is a checkpoint
+    def checkpoint(block):
+        if writer != None:
+            writer.settle(block)
+        if state != None:
+            state.save(block, results)
+
+    progress = None
+    if sys.stderr.isatty():
+        progress = Progress(targetCount(targets, excludes), results)
+        progress.start()
+    try:
+        scanner.scan(hosts, results, args['p'], checkpoint)
+    except KeyboardInterrupt:
+        if progress != None:
+            progress.stop()
+        if writer != None:
+            writer.flush()
+        if state != None:
+            state.save(scanner.block, results, False)
+            print('\n[!]Interrupted, run again with --resume to carry on from the last checkpoint')
+        quit()
+    if progress != None:
+        progress.stop()
+    scanner.close()
+    if state != None:
+        state.finishRun()
+    if writer != None:
+        writer.finish()
+
+    #batch mode stops here, the records are the results
+    if args['batch']:
+        print('[+]' + str(results.foundCount) + ' found, ' + str(results.freeCount) + ' potentially free, time taken in seconds : ' + str(time.time() - start))
+        output.flush()
+        quit()
             
-    ipFound=sorted(ipFound, key=ipaddress.ip_address)
-    ipFree=sorted(ipFree, key=ipaddress.ip_address)
+    ipFound = list(results.foundHosts())    #the store hands them back in address order
+    ipFree = list(results.freeHosts())
 
     #print results for both a list of IPs that were found to be live and the ones that did not respond to
     #ICMP requests or TCP connections
@@ -377,15 +1941,17 @@ if __name__ == "__main__":
     #print the time it took to do everything so far
     end = time.time()
     print('Time taken in seconds : ', end - start)
+    for phase, seconds in metrics.summary()['phases'].items():
+        print('     ' + phase + ' : ' + str(seconds))
 
-    # TODO: add while loop to allow the user to deep scan multiple hosts
-    #       one at a time until the user exits
-
-    #do a deep scan if the user wants, ask the user and return the value of the index
-    #if it's zero, the program exits, otherwise call for the full scan
+    #do a deep scan if the user wants, ask the user and return the picked indexes
+    #if there are none, the program exits, otherwise call for the full scan
     compIndexFullScan = pickListDoFullScan(len(ipFree))
-    if (int(compIndexFullScan)==0):
+    if (len(compIndexFullScan)==0):
         print('\n\nGoodbye\n\n')
-        exit
     else:
-        tcpSweep(ipFree, compIndexFullScan, portFree, portFound) 
+        tcpSweep([ipFree[index-1] for index in compIndexFullScan], results, maxInFlight, scanner.rtt, scanner.governor)
+        if state != None:
+            state.save([ipFree[index-1] for index in compIndexFullScan], results)
+    if writer != None:
+        writer.flush()
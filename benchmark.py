@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+import threading
+import os
+import io
+import time
+import json
+import socket
+import argparse
+import asyncio
+import selectors
+import contextlib
+
+import annoyedipscanner as scanner
+
+parser = argparse.ArgumentParser(prog='Annoyed IP Scanner Benchmark', description='Time each scan stage against a fake network on loopback, no real network is touched')
+parser.add_argument('-n', help='Hosts in the fake network (default is 64)', default=64, required=False)
+parser.add_argument('-d', help='Hosts to give the full range deep scan (default is 2)', default=2, required=False)
+parser.add_argument('-g', help='Port profile to time, can be given more than once, default is all three', choices=['fast', '1000', 'full'], action='append', required=False)
+parser.add_argument('-c', help='Maximum number of TCP connections in flight at once (default is 1000)', default=1000, required=False)
+parser.add_argument('-j', help='Also write the numbers to this file as JSON', required=False)
+
+##############################################################################################################
+# A fake network on 127.77.x.x, linux answers for all of 127/8 on loopback. The hosts come in four kinds:
+#   pingable    - answers the ping stand-in
+#   listening   - no ping, port 80 is open
+#   blackholed  - no ping, port 443 drops every SYN, the rest are closed
+#   closed      - no ping, every port sends a RST
+# A blackholed port is a listener whose accept queue is kept full, linux drops the SYNs that don't fit
+##############################################################################################################
+class FakeNetwork:
+    def __init__(self, count):
+        self.hosts = ['127.77.' + str(index // 254) + '.' + str(index % 254 + 1) for index in range(count)]
+        self.pingable = set(self.hosts[0::4])
+        self.listening = self.hosts[1::4]
+        self.blackholed = self.hosts[2::4]
+        self.sockets = []
+        self.selector = selectors.DefaultSelector()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.acceptLoop, daemon=True)
+
+    def start(self):
+        for ip in self.listening:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((ip, 80))
+            sock.listen(4096)
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+            self.sockets.append(sock)
+
+        for ip in self.blackholed:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((ip, 443))
+            sock.listen(0)
+            self.sockets.append(sock)
+            for x in range(4):      #fill the accept queue, nothing ever accepts from it
+                filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                filler.setblocking(False)
+                filler.connect_ex((ip, 443))
+                self.sockets.append(filler)
+
+        self.thread.start()
+        time.sleep(0.2)             #let the fillers finish their handshakes
+
+    #accept and drop connections to the open ports so their queues never fill up
+    def acceptLoop(self):
+        while not self.stopped.is_set():
+            for key, events in self.selector.select(0.05):
+                try:
+                    conn, addr = key.fileobj.accept()
+                    conn.close()
+                except OSError:
+                    pass
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        for sock in self.sockets:
+            sock.close()
+        self.selector.close()
+
+##############################################################################################################
+# Stand-in for the ICMP engine, pingable hosts answer after 'rtt' seconds and a sweep with silent hosts in it
+# waits one 'window' for them, the way the real engine waits out its timeout
+##############################################################################################################
+class FakePingEngine:
+    pingable = set()
+    rtt = 0.0005
+    window = 0.05
+    latencies = []
+
+    def __init__(self, timeout=1.0, tries=4):
+        pass
+
+    def available(self):
+        return True
+
+    def watchable(self, loop):
+        return True
+
+    def close(self):
+        pass
+
+    def sweep(self, ips, callback):
+        silent = []
+        for ip in ips:
+            if ip in self.pingable:
+                callback(ip, self.rtt)
+                FakePingEngine.latencies.append(self.rtt)
+            else:
+                silent.append(ip)
+        if len(silent) > 0:
+            time.sleep(self.window)
+        return silent
+
+    async def sweepAsync(self, ips, onReply, onSilent, budget):
+        loop = asyncio.get_running_loop()
+        waits = []
+
+        def decide(ip):
+            budget.release()
+            onSilent(ip)
+
+        for ip in ips:
+            await budget.acquire()
+            if ip in self.pingable:
+                budget.release()
+                onReply(ip, self.rtt)
+                FakePingEngine.latencies.append(self.rtt)
+            else:
+                waits.append(asyncio.sleep(self.window))
+                loop.call_later(self.window, decide, ip)
+        await asyncio.gather(*waits)
+        await asyncio.sleep(0)      #let the last call_later run
+
+##############################################################################################################
+# The real connect engine with the time of every connect written down
+##############################################################################################################
+class TimedConnectEngine(scanner.ConnectEngine):
+    latencies = []
+
+    async def connect(self, ip, port, timeout):
+        sent = time.monotonic()
+        result = await super().connect(ip, port, timeout)
+        TimedConnectEngine.latencies.append(time.monotonic() - sent)
+        return result
+
+##############################################################################################################
+# Samples thread count, open fds and resident memory every few milliseconds, keeps the peaks
+##############################################################################################################
+def residentBytes():
+    for line in scanner.readLines('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+    return 0
+
+def openFds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return 0
+
+class Sampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sampleLoop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.baseThreads = threading.active_count()
+        self.baseFds = openFds()
+        self.peakThreads = self.baseThreads
+        self.peakFds = self.baseFds
+        self.peakRss = residentBytes()
+
+    def sampleLoop(self):
+        while not self.stopped.wait(self.interval):
+            self.peakThreads = max(self.peakThreads, threading.active_count())
+            self.peakFds = max(self.peakFds, openFds())
+            self.peakRss = max(self.peakRss, residentBytes())
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def percentile(values, share):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+##############################################################################################################
+# Run one stage and measure it. 'work' returns the number of hosts it handled, every print in it is dropped
+##############################################################################################################
+def measure(stage, profile, work):
+    FakePingEngine.latencies = []
+    TimedConnectEngine.latencies = []
+    sampler = Sampler()
+    sampler.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        hosts, found = work()
+    elapsed = time.perf_counter() - start
+    sampler.stop()
+
+    latencies = TimedConnectEngine.latencies if stage != 'ping' else FakePingEngine.latencies
+    return {'stage': stage,
+            'profile': profile,
+            'hosts': hosts,
+            'found': found,
+            'seconds': round(elapsed, 3),
+            'hostsPerSec': round(hosts / elapsed, 1),
+            'probes': len(latencies),
+            'probesPerSec': round(len(latencies) / elapsed, 1),
+            'p50ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p99ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'peakThreads': sampler.peakThreads - sampler.baseThreads,
+            'peakFds': sampler.peakFds - sampler.baseFds,
+            'peakRssMB': round(sampler.peakRss / 1048576, 1)}
+
+def printTable(rows):
+    columns = ['stage', 'profile', 'hosts', 'found', 'seconds', 'hostsPerSec', 'probes', 'probesPerSec', 'p50ms', 'p99ms', 'peakThreads', 'peakFds', 'peakRssMB']
+    widths = [max(len(column), max(len(str(row[column])) for row in rows)) for column in columns]
+    line = '+' + '+'.join('-' * (width + 2) for width in widths) + '+'
+    print(line)
+    print('| ' + ' | '.join(column.rjust(width) for column, width in zip(columns, widths)) + ' |')
+    print(line)
+    for row in rows:
+        print('| ' + ' | '.join(str(row[column]).rjust(width) for column, width in zip(columns, widths)) + ' |')
+    print(line)
+
+##############################################################################################################
+# Entry point
+##############################################################################################################
+if __name__ == "__main__":
+    args = vars(parser.parse_args())
+    count = int(args['n'])
+    deepCount = int(args['d'])
+    maxInFlight = int(args['c'])
+    profiles = args['g'] if args['g'] != None else ['fast', '1000', 'full']
+    rows = []
+
+    network = FakeNetwork(count)
+    network.start()
+    FakePingEngine.pingable = network.pingable
+    scanner.PingEngine = FakePingEngine
+    scanner.ConnectEngine = TimedConnectEngine
+    targets = scanner.parseTargets(','.join(network.hosts), 1, 255)
+    print('[+]Fake network of ' + str(count) + ' hosts on ' + network.hosts[0] + ' - ' + network.hosts[-1])
+
+    try:
+        def pingStage():
+            results = scanner.ResultStore(targets)
+            scanner.pingSweep(scanner.targetHosts(targets), results, scanner.RttEstimator())
+            return count, results.foundCount
+        rows.append(measure('ping', '-', pingStage))
+
+        for profile in profiles:
+            if profile == 'full':
+                def deepStage():
+                    results = scanner.ResultStore(targets)
+                    hosts = [ip for ip in network.hosts if ip not in network.pingable][:deepCount]
+                    scanner.tcpSweep(hosts, results, maxInFlight)
+                    return len(hosts), results.foundCount
+                rows.append(measure('deep', profile, deepStage))
+                continue
+
+            def tcpStage():
+                results = scanner.ResultStore(targets)
+                rtt = scanner.RttEstimator()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ports = scanner.buildPortList(False, profile, 1, 255, None, '', True)
+                    scanner.pingSweep(scanner.targetHosts(targets), results, rtt)
+                free = results.freeCount
+                scanner.scanPorts(network.hosts, ports, results, maxInFlight, rtt)
+                return free, results.foundCount - len(network.pingable)
+            rows.append(measure('tcp', profile, tcpStage))
+
+            def pipelineStage():
+                results = scanner.ResultStore(targets)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ports = scanner.buildPortList(False, profile, 1, 255, None, '', True)
+                scanner.scanPipelined(network.hosts, ports, results, maxInFlight, scanner.RttEstimator())
+                return count, results.foundCount
+            rows.append(measure('pipeline', profile, pipelineStage))
+    finally:
+        network.stop()
+
+    printTable(rows)
+    print('[+]found is hosts that answered, the ping stage should find ' + str(len(network.pingable)) + ' and the tcp stage ' + str(len(network.listening)) + ', the pipeline does both')
+    if args['j'] != None:
+        with open(args['j'], 'w') as file:
+            json.dump(rows, file, indent=2)
@@ -0,0 +1,463 @@
+import io
+import json
+
+import pytest
+
+import annoyedipscanner as scanner
+
+def ip(address):
+    return scanner.ipaddress.IPv4Address(address)
+
+def span(start, end):
+    return int(ip(start)), int(ip(end))
+
+##############################################################################################################
+# Targets, ranges and exclusions
+##############################################################################################################
+def test_parseTarget_cidr_leaves_out_network_and_broadcast():
+    assert scanner.parseTarget('10.1.2.0/24', 1, 255) == span('10.1.2.1', '10.1.2.254')
+
+def test_parseTarget_point_to_point_and_host_routes_keep_every_address():
+    assert scanner.parseTarget('10.1.2.4/31', 1, 255) == span('10.1.2.4', '10.1.2.5')
+    assert scanner.parseTarget('10.1.2.4/32', 1, 255) == span('10.1.2.4', '10.1.2.4')
+
+def test_parseTarget_ranges():
+    assert scanner.parseTarget('10.1.2.5-10.1.3.7', 1, 255) == span('10.1.2.5', '10.1.3.7')
+    assert scanner.parseTarget(' 10.1.2.5-50 ', 1, 255) == span('10.1.2.5', '10.1.2.50')
+
+def test_parseTarget_subnet_uses_first_and_last():
+    assert scanner.parseTarget('10.1.2', 20, 30) == span('10.1.2.20', '10.1.2.30')
+
+def test_parseTarget_single_ip():
+    assert scanner.parseTarget('10.1.2.3', 1, 255) == span('10.1.2.3', '10.1.2.3')
+
+@pytest.mark.parametrize('target', ['10.1.2.5-300', '10.1.2.9-10.1.2.5', '300.1.1', '0.1.1', '10.x.1', '10.1.2.0/33', 'nonsense'])
+def test_parseTarget_rejects_bad_targets(target):
+    with pytest.raises(ValueError):
+        scanner.parseTarget(target, 1, 255)
+
+def test_parseTargets_skips_blanks():
+    assert scanner.parseTargets('10.0.0.1,, 10.0.0.3 ,', 1, 255) == [span('10.0.0.1', '10.0.0.1'), span('10.0.0.3', '10.0.0.3')]
+
+def test_mergeRanges_joins_overlapping_and_touching():
+    assert scanner.mergeRanges([(20, 30), (1, 5), (6, 8), (25, 40), (50, 50)]) == [[1, 8], [20, 40], [50, 50]]
+    assert scanner.mergeRanges([]) == []
+
+@pytest.mark.parametrize('excludes, expected', [
+    ([], list(range(1, 11))),
+    ([(1, 1)], list(range(2, 11))),                     #first address
+    ([(10, 12)], list(range(1, 10))),                   #last address, running past the end
+    ([(3, 4), (4, 6)], [1, 2] + list(range(7, 11))),    #overlapping excludes
+    ([(0, 20)], []),                                    #the whole range
+    ([(30, 40)], list(range(1, 11))),                   #nothing in range
+])
+def test_targetHosts_and_targetCount_agree_on_exclusions(excludes, expected):
+    targets = [(1, 10)]
+    hosts = list(scanner.targetHosts(targets, excludes))
+    assert hosts == [str(ip(address)) for address in expected]
+    assert scanner.targetCount(targets, excludes) == len(expected)
+
+def test_targetHosts_merges_overlapping_targets():
+    targets = [(5, 8), (1, 6), (20, 21)]
+    assert list(scanner.targetHosts(targets)) == [str(ip(address)) for address in [1, 2, 3, 4, 5, 6, 7, 8, 20, 21]]
+    assert scanner.targetCount(targets, [(7, 20)]) == 7     #1-6 and 21
+
+##############################################################################################################
+# Port specs
+##############################################################################################################
+def test_compilePorts_expands_ranges_in_order():
+    assert scanner.compilePorts('22, 80,1-3,') == [22, 80, 1, 2, 3]
+    assert scanner.compilePorts('65535') == [65535]
+
+@pytest.mark.parametrize('spec', ['', ',', '0', '65536', '5-3', 'ssh', '1-2-3', '-5'])
+def test_compilePorts_rejects_bad_specs(spec):
+    with pytest.raises(ValueError):
+        scanner.compilePorts(spec)
+
+##############################################################################################################
+# Result store
+##############################################################################################################
+def store(targets):
+    return scanner.ResultStore(scanner.parseTargets(targets, 1, 255))
+
+def test_ResultStore_offsets_run_across_ranges():
+    results = store('10.0.0.20-22,10.0.0.10-12')
+    assert results.offset('10.0.0.10') == 0
+    assert results.offset('10.0.0.12') == 2
+    assert results.offset('10.0.0.20') == 3
+    assert [results.address(offset) for offset in range(6)] == ['10.0.0.10', '10.0.0.11', '10.0.0.12', '10.0.0.20', '10.0.0.21', '10.0.0.22']
+    for outside in ['10.0.0.9', '10.0.0.15', '10.0.0.23']:
+        with pytest.raises(KeyError):
+            results.offset(outside)
+
+def test_ResultStore_found_wins_over_free():
+    results = store('10.0.0.1-4')
+    results.markFree('10.0.0.1')
+    results.markFree('10.0.0.1')
+    results.markFound('10.0.0.1', 'tcp')
+    results.markFree('10.0.0.1')            #too late, it answered
+    results.markFree('10.0.0.2')
+    assert (results.foundCount, results.freeCount) == (1, 1)
+    assert results.isFound('10.0.0.1') and not results.isFree('10.0.0.1')
+    assert results.probe('10.0.0.1') == 'tcp'
+    assert results.probe('10.0.0.3') == ''
+
+def test_ResultStore_ports_come_back_sorted_and_once():
+    results = store('10.0.0.1')
+    for port in [443, 22, 443, 80]:
+        results.addPort('10.0.0.1', port)
+    assert results.openPorts('10.0.0.1') == [22, 80, 443]
+
+def test_ResultStore_walk_returns_addresses_in_order_across_ranges():
+    results = store('10.0.1.0/28,10.0.0.0/28')
+    free = ['10.0.0.1', '10.0.0.8', '10.0.0.9', '10.0.0.14', '10.0.1.1', '10.0.1.14']
+    for address in reversed(free):
+        results.markFree(address)
+    results.markFound('10.0.0.2')
+    assert list(results.freeHosts()) == free
+    assert list(results.foundHosts()) == ['10.0.0.2']
+
+def test_ResultStore_freeIn_reads_only_the_query_ranges():
+    results = store('10.0.0.0/28,10.0.1.0/28')
+    for address in ['10.0.0.1', '10.0.0.7', '10.0.0.8', '10.0.0.14', '10.0.1.1', '10.0.1.9']:
+        results.markFree(address)
+    def freeIn(targets):
+        return list(results.freeIn(scanner.parseTargets(targets, 1, 255)))
+    assert freeIn('10.0.0.7-8') == ['10.0.0.7', '10.0.0.8']                 #across a byte of the bitmap
+    assert freeIn('10.0.0.8-10.0.1.5') == ['10.0.0.8', '10.0.0.14', '10.0.1.1']   #across the gap between ranges
+    assert freeIn('10.0.1.9,10.0.0.1') == ['10.0.0.1', '10.0.1.9']
+    assert freeIn('10.0.0.2-6') == []
+    assert freeIn('192.168.0.0/24') == []
+    assert freeIn('10.0.0.0/16') == list(results.freeHosts())
+
+##############################################################################################################
+# Scan state
+##############################################################################################################
+def test_ScanState_resumes_only_an_unfinished_run_of_the_same_targets(tmp_path):
+    state = scanner.ScanState(str(tmp_path / 'state.db'))
+    assert state.startRun('10.0.0.0/24', True) == False
+    started = state.started
+    assert state.startRun('10.0.1.0/24', True) == False
+    assert state.startRun('10.0.0.0/24', True) == True
+    assert state.started == started
+    state.finishRun()
+    assert state.startRun('10.0.0.0/24', True) == False
+    state.close()
+
+def test_ScanState_pendingHosts_orders_stale_free_then_unseen_then_stale_found(tmp_path):
+    state = scanner.ScanState(str(tmp_path / 'state.db'))
+    targets = scanner.parseTargets('10.0.0.1-7', 1, 255)
+    earlier = scanner.ResultStore(targets)
+    earlier.markFound('10.0.0.1', 'tcp')
+    earlier.addPort('10.0.0.1', 22)
+    earlier.markFree('10.0.0.2')
+    earlier.markFree('10.0.0.3')
+    earlier.markFound('10.0.0.4', 'icmp')
+    earlier.markFree('10.0.0.7')
+    state.save(['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4', '10.0.0.7'], earlier)
+    stale = [int(ip(address)) for address in ['10.0.0.3', '10.0.0.4', '10.0.0.7']]
+    state.db.executemany('UPDATE hosts SET lastProbed = 0 WHERE address = ?', [(address,) for address in stale])
+    assert state.portOrders() == {'10.0.0': [22]}
+
+    results = scanner.ResultStore(targets)
+    pending = list(state.pendingHosts(targets, scanner.parseTargets('10.0.0.6', 1, 255), results, 1))
+    assert pending == ['10.0.0.3', '10.0.0.7', '10.0.0.5', '10.0.0.4']     #10.0.0.6 is excluded
+    assert results.isFound('10.0.0.1') and results.probe('10.0.0.1') == 'tcp' and results.openPorts('10.0.0.1') == [22]
+    assert results.isFree('10.0.0.2')
+    assert (results.foundCount, results.freeCount) == (1, 1)
+    state.close()
+
+def test_ScanState_partial_save_keeps_free_hosts_back(tmp_path):
+    state = scanner.ScanState(str(tmp_path / 'state.db'))
+    targets = scanner.parseTargets('10.0.0.1-2', 1, 255)
+    results = scanner.ResultStore(targets)
+    results.markFound('10.0.0.1', 'icmp')
+    results.markFree('10.0.0.2')
+    state.save(['10.0.0.1', '10.0.0.2'], results, False)
+    assert [row[0] for row in state.db.execute('SELECT address FROM hosts')] == [int(ip('10.0.0.1'))]
+    state.close()
+
+##############################################################################################################
+# ICMP echoes
+##############################################################################################################
+def test_icmpChecksum():
+    assert scanner.icmpChecksum(b'\x08\x00\x00\x00\x00\x01\x00\x01') == 0xf7fd
+    assert scanner.icmpChecksum(b'\x01') == 0xfeff      #odd lengths are padded with a zero byte
+    assert scanner.icmpChecksum(scanner.icmpEcho(0x1234, 7)) == 0      #a packet with its checksum in sums to zero
+
+def echoReply(ident, seq, header=False):
+    reply = b'\x00' + scanner.icmpEcho(ident, seq)[1:]
+    if header:
+        reply = b'\x45' + bytes(19) + reply     #a 20 byte IPv4 header in front
+    return reply
+
+def pinger(raw, tries=4):
+    engine = scanner.PingEngine(tries=tries)
+    engine.close()          #matching never touches the socket
+    engine.raw = raw
+    engine.ident = 0x1234
+    return engine
+
+@pytest.mark.parametrize('raw, header', [(True, True), (False, False), (False, True)])
+def test_matchReply_finds_the_echo_by_seq(raw, header):
+    engine = pinger(raw)
+    waiting = {'10.0.0.1': (0, [0.0]), '10.0.0.2': (3, [0.0, 0.0])}
+    assert engine.matchReply(echoReply(0x1234, 3 * 4 + 2, header), '10.0.0.2', waiting) == None    #third echo never went out
+    assert engine.matchReply(echoReply(0x1234, 3 * 4 + 1, header), '10.0.0.2', waiting) != None
+    assert list(waiting) == ['10.0.0.1']
+    assert engine.matchReply(echoReply(0x1234, 0, header), '10.0.0.2', waiting) == None            #not waiting anymore
+
+def test_matchReply_seq_wraps_around():
+    engine = pinger(False)
+    waiting = {'10.0.0.1': (20000, [0.0, 0.0])}
+    assert engine.matchReply(echoReply(0, (20000 * 4 + 1) & 0xffff), '10.0.0.1', waiting) != None
+
+def test_matchReply_raw_sockets_only_take_our_ident():
+    waiting = {'10.0.0.1': (0, [0.0])}
+    assert pinger(True).matchReply(echoReply(0x4321, 0, True), '10.0.0.1', waiting) == None
+    assert pinger(False).matchReply(echoReply(0x4321, 0), '10.0.0.1', waiting) != None     #the kernel rewrites it on datagram sockets
+
+def test_matchReply_skips_anything_but_echo_replies():
+    waiting = {'10.0.0.1': (0, [0.0])}
+    assert pinger(True).matchReply(b'\x45' + bytes(19) + scanner.icmpEcho(0x1234, 0), '10.0.0.1', waiting) == None
+    assert pinger(False).matchReply(b'\x00\x00', '10.0.0.1', waiting) == None
+
+@pytest.mark.parametrize('osName, platform, expected', [('posix', 'linux', ['-c', '1', '-W', '1']),
+                                                        ('posix', 'darwin', ['-c', '1', '-W', '1000']),
+                                                        ('posix', 'freebsd14', ['-c', '1', '-W', '1000']),
+                                                        ('nt', 'win32', ['-n', '1', '-w', '1000'])])
+def test_pingHost_waits_a_second_in_the_units_of_each_platform(monkeypatch, osName, platform, expected):
+    calls = []
+    def run(command, **kwargs):
+        calls.append(command)
+        return scanner.subprocess.CompletedProcess(command, 1, b'')
+    monkeypatch.setattr(scanner.os, 'name', osName)
+    monkeypatch.setattr(scanner.sys, 'platform', platform)
+    monkeypatch.setattr(scanner.subprocess, 'run', run)
+    results = store('10.0.0.1')
+    scanner.pingHost('10.0.0.1', results)
+    assert calls == [['ping'] + expected + ['10.0.0.1']] * 4
+    assert results.isFree('10.0.0.1')
+
+##############################################################################################################
+# Round trip estimates
+##############################################################################################################
+def test_RttEstimator_unseen_hosts_borrow_their_subnet_and_keep_a_floor():
+    rtt = scanner.RttEstimator()
+    assert rtt.timeout('10.0.0.1') == rtt.initial
+    for x in range(50):
+        rtt.update('10.0.0.1', 0.0004)
+    assert rtt.timeout('10.0.0.1') == rtt.minTimeout       #its own samples can go all the way down
+    assert rtt.timeout('10.0.0.2') == rtt.minUnseen        #a neighbor of a fast host can't
+    assert rtt.timeout('10.9.9.9') == rtt.minUnseen        #nor can a host in a subnet nobody answered in
+    for x in range(10):
+        rtt.update('192.0.2.1', 0.15)
+    assert rtt.timeout('192.0.2.2') >= 0.15                #a slow subnet keeps its slow timeout
+    assert rtt.timeout('10.0.0.2') == rtt.minUnseen
+
+##############################################################################################################
+# Neighbor tables
+##############################################################################################################
+procFiles = {
+    '/proc/net/arp': [
+        'IP address       HW type     Flags       HW address            Mask     Device',
+        '192.168.1.1      0x1         0x2         aa:bb:cc:dd:ee:01     *        eth0',
+        '192.168.1.2      0x1         0x0         00:00:00:00:00:00     *        eth0',      #incomplete
+        '192.168.1.3      0x1         0x6         aa:bb:cc:dd:ee:03     *        eth0',      #complete and permanent
+        '192.168.1.4      0x1         0x2         00:00:00:00:00:00     *        eth0',
+    ],
+    '/proc/net/nf_conntrack': [
+        'ipv4     2 tcp      6 431999 ESTABLISHED src=192.168.1.50 dst=93.184.216.34 sport=51000 dport=443 src=93.184.216.34 dst=203.0.113.7 sport=443 dport=51000 [ASSURED] mark=0 use=1',
+        'ipv4     2 udp      17 29 src=192.168.1.60 dst=8.8.8.8 sport=5353 dport=53 [UNREPLIED] src=8.8.8.8 dst=192.168.1.60 sport=53 dport=5353 mark=0 use=1',
+        'ipv6     10 tcp      6 30 src=fe80::1 dst=fe80::2 sport=1 dport=2 src=fe80::2 dst=fe80::1 sport=2 dport=1 mark=0 use=1',
+    ],
+    '/proc/net/tcp': [
+        '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode',
+        '   0: 0100007F:0CEA 0100007F:D431 01 00000000:00000000 00:00000000 00000000     0        0 1 1 0 10 0',
+        '   1: 0101A8C0:0016 4601A8C0:C350 01 00000000:00000000 00:00000000 00000000     0        0 2 1 0 10 0',
+        '   2: 00000000:0016 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 3 1 0 10 0',     #listening
+        '   3: 0101A8C0:0016 4701A8C0:C351 06 00000000:00000000 00:00000000 00000000     0        0 4 1 0 10 0',     #TIME_WAIT
+    ],
+}
+
+def test_neighborHosts_parses_arp_conntrack_and_tcp(monkeypatch):
+    monkeypatch.setattr(scanner, 'readLines', lambda path: procFiles.get(path, []))
+    assert scanner.neighborHosts() == {'192.168.1.1', '192.168.1.3',           #resolved ARP entries
+                                       '192.168.1.50', '93.184.216.34',        #both ends of a replied flow
+                                       '127.0.0.1', '192.168.1.70'}            #far ends of established sockets
+
+def test_skipNeighbors_marks_them_found_and_passes_the_rest_on():
+    results = store('192.168.1.1-3')
+    assert list(scanner.skipNeighbors(scanner.targetHosts(results.ranges), {'192.168.1.2', '10.0.0.1'}, results)) == ['192.168.1.1', '192.168.1.3']
+    assert results.isFound('192.168.1.2') and results.probe('192.168.1.2') == 'neighbor'
+
+##############################################################################################################
+# Record writer
+##############################################################################################################
+def writerFor(targets, fmt='jsonl'):
+    results = store(targets)
+    stream = io.StringIO()
+    writer = scanner.ResultWriter(stream, fmt, results)
+    results.listener = writer.found
+    results.settler = writer.free
+    return results, writer, stream
+
+def records(stream):
+    return [(record['ip'], record['state'], record['probe'], record['ports']) for record in map(json.loads, stream.getvalue().splitlines())]
+
+def test_ResultWriter_writes_found_hosts_as_they_answer_and_free_ones_as_they_settle():
+    results, writer, stream = writerFor('10.0.0.1-3')
+    results.addPort('10.0.0.2', 22)
+    results.markFound('10.0.0.2', 'tcp')
+    results.markFree('10.0.0.1')
+    assert records(stream) == [('10.0.0.2', 'found', 'tcp', [22])]     #10.0.0.1 could still answer
+    results.markSettled('10.0.0.1')
+    results.markSettled('10.0.0.1')
+    results.markSettled('10.0.0.3')                                     #never probed, not free
+    assert records(stream)[1:] == [('10.0.0.1', 'free', '', [])]
+
+def test_ResultWriter_one_record_per_host_and_the_first_one_stands():
+    results, writer, stream = writerFor('10.0.0.1-3')
+    results.markFree('10.0.0.1')
+    results.markSettled('10.0.0.1')
+    results.markFound('10.0.0.1', 'tcp')        #the deep scan found it afterwards
+    results.markFree('10.0.0.3')
+    writer.settle(['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+    writer.finish()
+    assert records(stream) == [('10.0.0.1', 'free', '', []), ('10.0.0.3', 'free', '', [])]
+
+def test_ResultWriter_finish_writes_free_hosts_that_never_settled():
+    results, writer, stream = writerFor('10.0.0.1-2', 'csv')
+    writer.start()
+    results.markFree('10.0.0.2')
+    writer.finish()
+    rows = stream.getvalue().splitlines()
+    assert rows[0] == 'ip,state,probe,ports,time'
+    assert rows[1].startswith('10.0.0.2,free,,,') and len(rows) == 2
+    assert not writer.thread.is_alive()
+
+##############################################################################################################
+# Free address index, what the daemon answers from
+##############################################################################################################
+def sweptIndex(hold=300):
+    results = store('10.0.0.1-10')
+    for host in ['10.0.0.1', '10.0.0.2', '10.0.0.4', '10.0.0.9']:
+        results.markFree(host)
+    results.markFound('10.0.0.3', 'icmp')
+    index = scanner.FreeIndex(hold=hold)
+    index.update(results)
+    return index
+
+def test_FreeIndex_errors_until_the_first_sweep_finishes():
+    index = scanner.FreeIndex()
+    with pytest.raises(LookupError):
+        index.take(1)
+    assert index.answer('free 1') == {'error': 'no sweep has finished yet'}
+    assert index.answer('status') == {'sweeps': 0, 'swept': None, 'found': 0, 'free': 0}
+
+def test_FreeIndex_holds_what_it_hands_out():
+    index = sweptIndex()
+    assert index.take(2) == ['10.0.0.1', '10.0.0.2']
+    assert index.take(5) == ['10.0.0.4', '10.0.0.9']
+    assert index.take(1) == []
+    index.update(index.results)                 #a new sweep doesn't free them early
+    assert index.take(1) == []
+
+def test_FreeIndex_hands_them_out_again_once_the_hold_is_over():
+    index = sweptIndex(hold=0)
+    assert index.take(2) == ['10.0.0.1', '10.0.0.2']
+    assert index.take(2) == ['10.0.0.1', '10.0.0.2']
+
+def test_FreeIndex_answers_free_queries_inside_targets():
+    index = sweptIndex()
+    reply = index.answer('free 2 10.0.0.2-8\n')
+    assert reply == {'free': ['10.0.0.2', '10.0.0.4'], 'swept': index.swept}
+    assert index.answer('free 2 10.0.0.0/29')['free'] == ['10.0.0.1']
+    assert index.answer('free 1 10.0.1.0/24')['free'] == []
+
+@pytest.mark.parametrize('line, error', [('free x', 'x is not a count'), ('free -1', '-1 is not a count'),
+                                         ('free 1 10.0.0.1-300', None), ('free', 'expected free N [targets] or status'),
+                                         ('hello', 'expected free N [targets] or status'), ('', 'expected free N [targets] or status')])
+def test_FreeIndex_bad_queries_get_an_error(line, error):
+    index = sweptIndex()
+    reply = index.answer(line)
+    assert list(reply) == ['error'] and (error == None or reply['error'] == error)
+    assert index.held == {}
+
+def test_FreeIndex_status():
+    index = sweptIndex()
+    assert index.answer('status') == {'sweeps': 1, 'swept': index.swept, 'found': 1, 'free': 4}
+
+##############################################################################################################
+# Port order
+##############################################################################################################
+def test_orderPorts_puts_ranked_ports_first_and_drops_repeats():
+    assert list(scanner.orderPorts([9999, 8080, 22, 80, 22])) == [80, 22, 8080, 9999]
+    assert list(scanner.orderPorts([8080, 22, 80, 9999], [9999, 22, 1])) == [9999, 22, 8080, 80]      #learned order, the rest keep theirs
+
+def test_portSet_profiles_and_specs():
+    assert list(scanner.portSet(None)) == list(scanner.portSet('fast'))
+    assert len(scanner.portSet('fast')) == 11 and scanner.portSet('fast')[0] == 80
+    assert len(scanner.portSet('1000')) == len(set(scanner.portProfiles['1000']))
+    full = scanner.portSet('full')
+    assert len(full) == 65535 and list(full[:3]) == [80, 23, 443] and sorted(full) == list(range(1, 65536))
+    assert list(scanner.portSet('5000-5002,22')) == [22, 5000, 5001, 5002]
+    with pytest.raises(ValueError):
+        scanner.portSet('fastest')
+
+##############################################################################################################
+# Connect engine, against a loopback port that drops every SYN. Linux drops the SYNs that don't fit in a
+# listener's accept queue, so a listen(0) socket with its queue kept full never answers
+##############################################################################################################
+@pytest.fixture
+def blackhole():
+    listener = scanner.socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    fillers = []
+    for x in range(4):
+        filler = scanner.socket.socket()
+        filler.setblocking(False)
+        filler.connect_ex(('127.0.0.1', port))
+        fillers.append(filler)
+    scanner.time.sleep(0.1)
+    yield port
+    for sock in fillers + [listener]:
+        sock.close()
+
+def slowEngine():
+    return scanner.ConnectEngine(rtt=scanner.RttEstimator(initial=5.0, maxTimeout=5.0), retries=0)
+
+def test_ConnectEngine_cancel_drops_only_that_hosts_probes(blackhole):
+    async def run():
+        engine = slowEngine()
+        probe = scanner.asyncio.ensure_future(engine.tracked('127.0.0.1', blackhole))
+        await scanner.asyncio.sleep(0.1)
+        assert '127.0.0.1' in engine.inFlight
+        engine.cancel('127.0.0.2')              #nothing out to it
+        assert not probe.done()
+        engine.cancel('127.0.0.1')
+        assert await probe == None
+        assert engine.inFlight == {} and engine.cancelled == set()
+    scanner.asyncio.run(scanner.asyncio.wait_for(run(), 3))
+
+def test_ConnectEngine_cancelling_the_caller_still_raises(blackhole):
+    async def run():
+        engine = slowEngine()
+        caller = scanner.asyncio.ensure_future(engine.tracked('127.0.0.1', blackhole))
+        await scanner.asyncio.sleep(0.1)
+        caller.cancel()
+        with pytest.raises(scanner.asyncio.CancelledError):
+            await caller
+        assert engine.inFlight == {}
+    scanner.asyncio.run(scanner.asyncio.wait_for(run(), 3))
+
+def test_ConnectEngine_closed_port_is_a_refusal():
+    closed = scanner.socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    port = closed.getsockname()[1]
+    closed.close()
+    async def run():
+        return await scanner.ConnectEngine().tracked('127.0.0.1', port)
+    assert scanner.asyncio.run(run()) == scanner.errno.ECONNREFUSED